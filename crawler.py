@@ -1,8 +1,17 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from pathlib import Path
+import os
+import importlib.util
 import json
 import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlparse
 from tqdm import tqdm
 
 from selenium import webdriver
@@ -12,6 +21,8 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
+OPENREVIEW_URL = "https://openreview.net/"
+
 
 def get_driver(driver="chrome", headless=False, userdata_dir="selenium"):
     """
@@ -55,6 +66,89 @@ def get_driver(driver="chrome", headless=False, userdata_dir="selenium"):
     return driver
 
 
+class DriverPool:
+    """
+    Bounded pool of webdrivers, created on demand, each with its own user data dir
+    """
+
+    def __init__(self, size=4, driver="chrome", headless=True, userdata_dir="selenium"):
+        self.size = size
+        self.driver_name = driver
+        self.headless = headless
+        self.userdata_dir = userdata_dir
+        self.idle = queue.Queue()
+        self.drivers = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def driver(self):
+        """
+        Borrow a webdriver, waiting for one to be free if the pool is full
+        """
+        driver = None
+        with self.lock:
+            if self.idle.empty() and len(self.drivers) < self.size:
+                driver = get_driver(self.driver_name, headless=self.headless,
+                                    userdata_dir="{}_{}".format(self.userdata_dir, len(self.drivers)))
+                self.drivers.append(driver)
+        if driver is None:
+            driver = self.idle.get()
+        try:
+            yield driver
+        finally:
+            self.idle.put(driver)
+
+    def close(self):
+        for driver in self.drivers:
+            driver.quit()
+        self.drivers = []
+
+
+class HostRateLimiter:
+    """
+    Polite crawling: at least min_interval seconds between two requests to the same host
+    """
+
+    def __init__(self, min_interval=1.0):
+        self.min_interval = min_interval
+        self.next_time = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time.get(host, now))
+            self.next_time[host] = start + self.min_interval
+        time.sleep(start - now)
+
+
+host_limiter = HostRateLimiter()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size=16, max_retries=5):
+    """
+    Keep-alive HTTP session shared by all downloads, retrying 429 / 5xx with backoff and Retry-After
+    :param pool_size: connections kept per host
+    :param max_retries: retries of a request
+    :return: requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=max_retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=['GET', 'HEAD'], respect_retry_after_header=True)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.headers['User-Agent'] = 'Mozilla/5.0'
+    return _session
+
+
 def get_neurips_pages(driver=None, year=2022):
     """
     Get the openreview pages
@@ -123,80 +217,157 @@ def get_neurips_pages(driver=None, year=2022):
     #     page += 1
 
 
-def get_paper(link, out_file, wait_class='note_content_field', driver=None):
+def fetch_page(link, out_file, wait_class='note_content_field'):
+    """
+    Get a paper page with a plain HTTP request, which only works if the page is rendered server-side
+    :param link: link of OpenReview paper
+    :param out_file: output file
+    :param wait_class: html class the page must contain
+    :return: whether the page was saved
+    """
+    host_limiter.wait(link)
+    try:
+        response = get_session().get(link, timeout=30)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(e)
+        return False
+    if wait_class not in response.text:
+        return False
+    with open(out_file, "w") as f:
+        f.write(response.text)
+    return True
+
+
+def get_paper(link, out_file, wait_class='note_content_field', driver=None, pool=None, http_first=False):
     """
     Get the paper page
     :param link: link of OpenReview paper
     :param out_file: output file
     :param wait_class: html class to wait for
     :param driver: webdriver
+    :param pool: DriverPool to borrow a webdriver from instead
+    :param http_first: try a plain HTTP request before falling back to the webdriver
     :return:
     """
+    if http_first and fetch_page(link, out_file, wait_class=wait_class):
+        return
+    if pool is not None:
+        with pool.driver() as driver:
+            return get_paper(link, out_file, wait_class=wait_class, driver=driver)
     if driver is None:
         driver = get_driver(headless=False)
+    host_limiter.wait(link)
     driver.get(link)
     WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CLASS_NAME, wait_class)))
     with open(out_file, "w") as f:
         f.write(driver.page_source)
 
 
-def retry_request(url, max_retries=5):
-    for i in range(max_retries):
-        try:
-            return requests.get(url, headers={'User-Agent': 'Mozilla/5.0'})
-        except Exception as e:
-            print(e)
-    return None
+def download_file(url, out_path, revalidate=False, chunk_size=1 << 16):
+    """
+    Stream a file to disk through the shared session. Its ETag / Last-Modified are kept in <out_path>.headers.json
+    :param url: file url
+    :param out_path: output file
+    :param revalidate: send a conditional request for an existing file instead of skipping it
+    :param chunk_size: bytes written at a time
+    :return: whether the file was (re-)downloaded
+    """
+    out_path = Path(out_path)
+    headers_path = out_path.with_name(out_path.name + '.headers.json')
+    if out_path.exists() and not revalidate:
+        return False
+
+    headers = {}
+    if out_path.exists() and headers_path.exists():
+        validators = json.load(headers_path.open())
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    host_limiter.wait(url)
+    try:
+        with get_session().get(url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 304:
+                return False
+            response.raise_for_status()
+            # a partial download never shows up as a cached file
+            part_path = out_path.with_name(out_path.name + '.part')
+            with open(part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+            part_path.replace(out_path)
+            with open(headers_path, 'w') as f:
+                json.dump({'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified')}, f)
+    except requests.RequestException as e:
+        print("Error: Cannot download {}: {}".format(url, e))
+        return False
+    return True
+
+
+REVIEW_SCORES = ['rating', 'confidence', 'soundness', 'presentation', 'contribution']
+
+
+def _score(value):
+    """
+    Leading number of a review score, e.g. "6: Weak Accept" or "3 good"
+    :param value: score text, or None if the review has no such field
+    :return: float, or None if missing or not numeric
+    """
+    if value is None:
+        return None
+    try:
+        return float(value.split(':')[0].split(' ')[0])
+    except ValueError:
+        return None
 
 
-def extract_paper_info(paper, is_accepted=True, driver=None):
+def review_record(parsed):
     """
-    Extract paper info
-    :param paper:
-    :param is_accepted:
-    :param driver:
-    :return:
+    Typed scores of a review
+    :param parsed: dict of review field -> text, as in reviews_parsed
+    :return: dict of score name -> float or None
     """
-    link = "https://openreview.net/" + paper['href']
-    pdf_link = link.replace("forum?id=", "pdf?id=")
-    paper_id = paper['href'].split("=")[-1]
-    title = paper.text.strip().replace(" ", "_").replace("/", "_").replace("?", "_").replace('"', "_")
-    cache_path = Path("cache/{}".format('accepted' if is_accepted else 'rejected'))
-    cache_path.mkdir(parents=True, exist_ok=True)
-    cache_html_path = cache_path / "{}.html".format(title)
-    cache_pdf_path = cache_path / "{}.pdf".format(title)
+    return {k: _score(parsed.get(k.capitalize())) for k in REVIEW_SCORES}
 
-    paper_res = {
-        'link': link,
-        'pub_url': 'https://openreview.net/forum?id={}'.format(paper_id),
-        'pdf_link': pdf_link,
-        'paper_id': paper_id,
-        'title': title,
-        'is_accepted': is_accepted
-    }
 
-    if not cache_pdf_path.exists():
-        pdf_response = retry_request(pdf_link)
-        if pdf_response is None:
-            print("Error: Cannot download pdf")
-        else:
-            with open(cache_pdf_path, "wb") as f:
-                f.write(pdf_response.content)
+def _score_avgs(records):
+    res = {}
+    for k in REVIEW_SCORES:
+        values = [r[k] for r in records if r[k] is not None]
+        res[k + '_avg'] = round(sum(values) / len(values), 3) if len(values) > 0 else None
+    return res
 
-    if not cache_html_path.exists():
-        get_paper(link, cache_html_path, driver=driver)
 
-    with open(cache_html_path, 'r') as f:
-        html_text = f.read()
+def _forum_fields(meta, reviews, reviews_parsed):
+    """
+    Fields of raw.json parsed from a forum page
+    :param meta: (recommendation, confidence, meta review) texts, or None if the page has no meta review
+    :param reviews: list of review texts
+    :param reviews_parsed: list of dicts of review field -> text
+    """
+    records = [review_record(r) for r in reviews_parsed]
+    res = {'meta_review': None}
+    if meta is not None and meta[2]:
+        res['meta_review'] = meta[0] + "\n" + meta[1] + "\n" + meta[2]
+    res['reviews'] = ['Reviewer {}: \n'.format(idx_r + 1) + r + '\n\n' for idx_r, r in enumerate(reviews)]
+    res['reviews_parsed'] = reviews_parsed
+    res.update(_score_avgs(records))
+    res['review_scores'] = records
+    return res
+
+
+def _parse_forum_bs4(html_text):
     paper_soup = BeautifulSoup(html_text, 'html.parser')
 
     span = [s for s in paper_soup.find_all('span', {'class': 'note_content_field'}) if
             s.text == 'Metareview: ']
-    meta_review = span[0].next_sibling.text.strip() if len(span) > 0 else None
-    confidence = span[0].parent.previous_sibling.text
-    recommendation = span[0].parent.previous_sibling.previous_sibling.text
-    paper_res[
-        'meta_review'] = recommendation + "\n" + confidence + "\n" + meta_review if meta_review else None
+    meta = None
+    if len(span) > 0:
+        meta = (span[0].parent.previous_sibling.previous_sibling.text, span[0].parent.previous_sibling.text,
+                span[0].next_sibling.text.strip())
 
     # div with class "note panel" whose first child with text "Official Review of Paper"
 
@@ -206,68 +377,389 @@ def extract_paper_info(paper, is_accepted=True, driver=None):
     reviewers_parsed = [[{x.text.replace(': ', '').strip(): x.next_sibling.text.strip()} for x in
                          r.find_all('span', {'class': 'note_content_field'})] for r in reviewers]
     reviewers_parsed = [{k: v for d in r for k, v in d.items()} for r in reviewers_parsed]
-    reviewers_text = []
-    for idx_r, r in enumerate(reviewers):
-        review = '\n'.join([rr.text.strip() for rr in r.find_all('div', {'class': 'note_contents'}) if
-                            rr.text.strip() != 'Official Review of Paper'])
-        review = 'Reviewer {}: \n'.format(idx_r + 1) + review + '\n\n'
-        reviewers_text.append(review)
-    paper_res['reviews'] = reviewers_text
-    paper_res['reviews_parsed'] = reviewers_parsed
-    paper_res['rating_avg'] = round(
-        sum([float(x['Rating'].split(':')[0]) for x in reviewers_parsed]) / len(reviewers_parsed),
-        3) if len(
-        reviewers_parsed) > 0 else None
-    paper_res['confidence_avg'] = round(
-        sum([float(x['Confidence'].split(':')[0]) for x in reviewers_parsed]) / len(reviewers_parsed),
-        3) if len(reviewers_parsed) > 0 else None
-    paper_res['soundness_avg'] = round(
-        sum([float(x['Soundness'].split(':')[0].split(' ')[0]) for x in reviewers_parsed]) / len(
-            reviewers_parsed), 3) if len(reviewers_parsed) > 0 else None
-    paper_res['presentation_avg'] = round(
-        sum([float(x['Presentation'].split(':')[0].split(' ')[0]) for x in reviewers_parsed]) / len(
-            reviewers_parsed), 3) if len(reviewers_parsed) > 0 else None
-    paper_res['contribution_avg'] = round(
-        sum([float(x['Contribution'].split(':')[0].split(' ')[0]) for x in reviewers_parsed]) / len(
-            reviewers_parsed), 3) if len(reviewers_parsed) > 0 else None
+    reviewers_text = ['\n'.join([rr.text.strip() for rr in r.find_all('div', {'class': 'note_contents'}) if
+                                 rr.text.strip() != 'Official Review of Paper']) for r in reviewers]
+    return _forum_fields(meta, reviewers_text, reviewers_parsed)
+
+
+def _sibling(el, offset):
+    """
+    Sibling of an lxml element the way BeautifulSoup navigates it, counting the text between elements as nodes
+    :param el: lxml element
+    :param offset: 1 for next_sibling, -1 for previous_sibling, ...
+    :return: element, str, or None
+    """
+    parent = el.getparent()
+    nodes = [parent.text] if parent.text is not None else []
+    for child in parent:
+        nodes.append(child)
+        if child.tail is not None:
+            nodes.append(child.tail)
+    idx = next(i for i, n in enumerate(nodes) if n is el) + offset
+    return nodes[idx] if 0 <= idx < len(nodes) else None
+
+
+def _string(s):
+    # BeautifulSoup collapses whitespace-only strings to a newline or a space
+    if s.strip(' \n\t\x0c\r'):
+        return s
+    return '\n' if '\n' in s else ' '
+
+
+def _text(node):
+    return _string(node) if isinstance(node, str) else ''.join(_string(s) for s in node.itertext())
+
+
+def _parse_forum_lxml(html_text):
+    import lxml.html
+
+    doc = lxml.html.fromstring(html_text)
+    meta = None
+    reviews, reviews_parsed = [], []
+    # one pass over the document for the meta review fields and the note panels, the reviews are then read from
+    # their own panel only
+    for el in doc.iter('span', 'div'):
+        classes = el.get('class')
+        if classes is None:
+            continue
+        if meta is None and el.tag == 'span' and 'note_content_field' in classes.split() and \
+                _text(el) == 'Metareview: ':
+            meta = (_text(_sibling(el.getparent(), -2)), _text(_sibling(el.getparent(), -1)),
+                    _text(_sibling(el, 1)).strip())
+        elif el.tag == 'div' and classes == 'note panel' and \
+                _text(el).strip().startswith("Official Review of Paper"):
+            reviews_parsed.append({_text(x).replace(': ', '').strip(): _text(_sibling(x, 1)).strip()
+                                   for x in el.iter('span') if 'note_content_field' in x.get('class', '').split()})
+            contents = [_text(x).strip() for x in el.iter('div') if
+                        'note_contents' in x.get('class', '').split()]
+            reviews.append('\n'.join([c for c in contents if c != 'Official Review of Paper']))
+    return _forum_fields(meta, reviews, reviews_parsed)
+
+
+def parse_forum(html_text):
+    """
+    Parse the meta review and the reviews of an OpenReview forum page.
+    Uses lxml when it is installed, otherwise BeautifulSoup with html.parser
+    :param html_text: html of the forum page
+    :return: dict with meta_review, reviews, reviews_parsed, the score averages and review_scores, the typed
+    scores of each review
+    """
+    if importlib.util.find_spec('lxml') is None:
+        return _parse_forum_bs4(html_text)
+    return _parse_forum_lxml(html_text)
+
+
+def benchmark_parser(folders=('cache/accepted', 'cache/rejected')):
+    """
+    Time both parsers on the cached forum pages and check they agree
+    :param folders: folders with cached html pages
+    :return: dict of parser -> pages per second
+    """
+    pages = []
+    for folder in folders:
+        for path in sorted(Path(folder).glob("*.html")):
+            with open(path, 'r') as f:
+                pages.append((path, f.read()))
+    res = {}
+    outputs = {}
+    for name, parse in [('bs4', _parse_forum_bs4), ('lxml', _parse_forum_lxml)]:
+        start = time.perf_counter()
+        outputs[name] = [parse(html_text) for _, html_text in pages]
+        res[name] = len(pages) / (time.perf_counter() - start)
+        print("{}: {} pages, {:.1f} pages/s".format(name, len(pages), res[name]))
+    mismatches = [str(path) for (path, _), a, b in zip(pages, outputs['bs4'], outputs['lxml']) if a != b]
+    if mismatches:
+        print("Parsers disagree on {} pages: {}".format(len(mismatches), mismatches[:5]))
+    return res
+
+
+def paper_meta(paper, is_accepted=True, base_url=OPENREVIEW_URL):
+    """
+    Fields of raw.json known from the listing page, before the forum page is parsed
+    :param paper: <a> tag of the paper on the listing page
+    :param is_accepted:
+    :param base_url: OpenReview url
+    :return: dict with link, pub_url, pdf_link, paper_id, title and is_accepted
+    """
+    link = base_url + paper['href']
+    paper_id = paper['href'].split("=")[-1]
+    return {
+        'link': link,
+        'pub_url': 'https://openreview.net/forum?id={}'.format(paper_id),
+        'pdf_link': link.replace("forum?id=", "pdf?id="),
+        'paper_id': paper_id,
+        'title': paper.text.strip().replace(" ", "_").replace("/", "_").replace("?", "_").replace('"', "_"),
+        'is_accepted': is_accepted
+    }
+
+
+def listed_papers(html_text, is_accepted=True):
+    """
+    Papers on a cached listing page
+    :param html_text: html of the listing page
+    :param is_accepted: return the accepted papers, otherwise the rejected ones
+    :return: list of <a> tags
+    """
+    soup = BeautifulSoup(html_text, 'html.parser')
+    accepted_papers = [a for a in soup.find('div', {'id': 'accepted-papers'}).find_all('a', href=True) if
+                       'forum?id=' in a['href']]
+    if is_accepted:
+        return accepted_papers
+    return [a for a in soup.find_all('a', href=True) if 'forum?id=' in a['href'] if a not in accepted_papers]
+
+
+def extract_paper_info(paper, is_accepted=True, driver=None, pool=None, base_url=OPENREVIEW_URL, downloader=None,
+                       http_first=False, cache_dir=Path("cache"), revalidate=False, downloads=None):
+    """
+    Extract paper info
+    :param paper:
+    :param is_accepted:
+    :param driver:
+    :param pool: DriverPool used instead of driver when the page is not cached
+    :param base_url: OpenReview url, e.g. a local static server for testing
+    :param downloader: executor the PDF download is submitted to, instead of downloading it before extracting
+    :param http_first: try a plain HTTP request for the page before the webdriver
+    :param cache_dir: folder the accepted and rejected pages and PDFs are cached in
+    :param revalidate: send a conditional request for a cached PDF instead of skipping it
+    :param downloads: list the (url, future) of the download submitted to the downloader is appended to
+    :return:
+    """
+    paper_res = paper_meta(paper, is_accepted=is_accepted, base_url=base_url)
+    link, pdf_link, title = paper_res['link'], paper_res['pdf_link'], paper_res['title']
+    cache_path = Path(cache_dir) / ('accepted' if is_accepted else 'rejected')
+    cache_path.mkdir(parents=True, exist_ok=True)
+    cache_html_path = cache_path / "{}.html".format(title)
+    cache_pdf_path = cache_path / "{}.pdf".format(title)
+
+    if downloader is not None:
+        future = downloader.submit(download_file, pdf_link, cache_pdf_path, revalidate=revalidate)
+        if downloads is not None:
+            downloads.append((pdf_link, future))
+    else:
+        download_file(pdf_link, cache_pdf_path, revalidate=revalidate)
+
+    if not cache_html_path.exists():
+        get_paper(link, cache_html_path, driver=driver, pool=pool, http_first=http_first)
+
+    with open(cache_html_path, 'r') as f:
+        html_text = f.read()
+    paper_res.update(parse_forum(html_text))
     return {title: paper_res}
 
 
-def extract_neurips_main_pages():
+class RawStore:
+    """
+    Append-only JSONL store of the crawled papers, one line per paper: {title: paper}, with the ids of the completed
+    papers in a manifest next to it (raw.done), so an interrupted crawl restarts where it stopped.
     """
-    Extract reviews information to raw.json
+
+    def __init__(self, path, resume=True):
+        """
+        :param path: path of the .jsonl file
+        :param resume: keep the papers already in the store, otherwise start from an empty one
+        """
+        self.path = Path(path)
+        self.manifest_path = self.path.with_suffix('.done')
+        if not resume:
+            self.path.unlink(missing_ok=True)
+            self.manifest_path.unlink(missing_ok=True)
+        self.done = set()
+        if self.manifest_path.exists():
+            with open(self.manifest_path, 'r') as f:
+                self.done = set(line.strip() for line in f if line.strip())
+        self.lock = threading.Lock()
+        self.appended = 0
+        self.f = open(self.path, 'a')
+        self.manifest = open(self.manifest_path, 'a')
+
+    def append(self, paper_res):
+        """
+        Persist a paper, then mark it completed
+        :param paper_res: {title: paper}, as returned by extract_paper_info
+        """
+        with self.lock:
+            self.f.write(json.dumps(paper_res) + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            # the id is only written once its record is on disk
+            for paper in paper_res.values():
+                if 'paper_id' in paper:
+                    self.manifest.write(paper['paper_id'] + '\n')
+                    self.done.add(paper['paper_id'])
+            self.manifest.flush()
+            self.appended += 1
+
+    def __contains__(self, paper_id):
+        return paper_id in self.done
+
+    def load(self):
+        """
+        :return: dict of title -> paper, in crawl order, the last record of a title wins
+        """
+        res = {}
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    res.update(json.loads(line))
+                except json.JSONDecodeError:
+                    # torn last line of an interrupted crawl, its paper is not in the manifest
+                    continue
+        return res
+
+    def compact(self, dst_path):
+        """
+        Write the store as raw.json
+        :param dst_path: output .json path
+        :return: number of papers
+        """
+        with self.lock:
+            if not self.f.closed:
+                self.f.flush()
+        res = self.load()
+        with open(dst_path, 'w') as f:
+            json.dump(res, f, indent=4)
+        print('Compacted {} papers to {}'.format(len(res), Path(dst_path).name))
+        return len(res)
+
+    def close(self):
+        with self.lock:
+            if not self.f.closed:
+                self.f.close()
+                self.manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def extract_neurips_main_pages(workers=1, base_url=OPENREVIEW_URL, min_interval=1.0, pdf_workers=4, http_first=False,
+                               resume=True, cache_dir=Path("cache"), revalidate=False):
+    """
+    Extract reviews information to raw.json.
+    Papers are appended to raw.jsonl as they are extracted, and raw.json is compacted from it at the end
+    :param workers: number of papers crawled concurrently, each worker with its own headless webdriver
+    :param base_url: OpenReview url, e.g. a local static server for testing
+    :param min_interval: seconds between two requests to the same host
+    :param pdf_workers: number of PDFs downloaded concurrently, in the background of the page extraction
+    :param http_first: try plain HTTP requests for forum pages before the webdriver
+    :param resume: skip the papers already in raw.jsonl
+    :param cache_dir: folder with the listing pages, where the papers, raw.jsonl and raw.json are written
+    :param revalidate: revalidate the cached PDFs with conditional requests (ETag / Last-Modified)
     :return:
     """
-    driver = get_driver(headless=False)
+    cache_dir = Path(cache_dir)
+    host_limiter.min_interval = min_interval
+    if workers > 1:
+        driver = None
+        pool = DriverPool(size=workers, headless=True)
+    else:
+        driver = get_driver(headless=False)
+        pool = None
 
-    pages = list((cache_folder / 'pages').glob("NeurIPS*.html"))
+    pages = list((cache_dir / 'pages').glob("NeurIPS*.html"))
     pages_accepted = [p for p in pages if 'reject' not in p.name]
     pages_rejected = [p for p in pages if 'reject' in p.name]
 
-    res = {}
+    store = RawStore(cache_dir / "raw.jsonl", resume=resume)
+    downloads = []
+    if len(store.done) > 0:
+        print("Resuming, {} papers already extracted".format(len(store.done)))
 
     def process_pages(pages_set, is_accepted=True):
         for page in tqdm(pages_set, total=len(pages_set)):
             with open(page, 'r') as f:
-                html_text = f.read()
-            soup = BeautifulSoup(html_text, 'html.parser')
-
-            accepted_papers = [a for a in soup.find('div', {'id': 'accepted-papers'}).find_all('a', href=True) if
-                               'forum?id=' in a['href']]
-            rejected_papers = [a for a in soup.find_all('a', href=True) if 'forum?id=' in a['href'] if
-                               a not in accepted_papers]
-
-            papers = accepted_papers if is_accepted else rejected_papers
-
-            for paper in tqdm(papers, total=len(papers)):
-                paper_res = extract_paper_info(paper, is_accepted=is_accepted, driver=driver)
-                res.update(paper_res)
-
-    process_pages(pages_accepted, is_accepted=True)
-    process_pages(pages_rejected, is_accepted=False)
-
-    with open(cache_folder / "raw.json", 'w') as f:
+                papers = [p for p in listed_papers(f.read(), is_accepted=is_accepted) if
+                          p['href'].split("=")[-1] not in store]
+
+            def extract(paper):
+                return extract_paper_info(paper, is_accepted=is_accepted, driver=driver, pool=pool, base_url=base_url,
+                                          downloader=downloader, http_first=http_first, cache_dir=cache_dir,
+                                          revalidate=revalidate, downloads=downloads)
+
+            # map keeps the order of the papers on the page
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for paper_res in tqdm(executor.map(extract, papers), total=len(papers)):
+                    store.append(paper_res)
+
+    try:
+        with ThreadPoolExecutor(max_workers=pdf_workers) as downloader:
+            process_pages(pages_accepted, is_accepted=True)
+            process_pages(pages_rejected, is_accepted=False)
+    finally:
+        if pool is not None:
+            pool.close()
+        store.close()
+
+    # download_file reports its request errors, any other error, e.g. writing the file, is only in its future
+    failed = [(url, future.exception()) for url, future in downloads if future.exception() is not None]
+    for url, e in failed:
+        print("Error: Cannot download {}: {}".format(url, e))
+    print("Downloaded {} PDFs, {} failed".format(
+        sum(1 for _, future in downloads if future.exception() is None and future.result()), len(failed)))
+
+    # raw.json is kept as is when nothing new was crawled
+    if store.appended or not (cache_dir / "raw.json").exists():
+        store.compact(cache_dir / "raw.json")
+
+
+def _parse_cached(path):
+    with open(path, 'r') as f:
+        return parse_forum(f.read())
+
+
+def reextract_raw(workers=None, cache_dir=Path("cache"), base_url=OPENREVIEW_URL, chunksize=8):
+    """
+    Re-extract raw.json from the cached forum pages, without a webdriver or any request.
+    Listing page fields come from the cached listing pages and the existing raw.json, the forum pages are parsed
+    on a process pool and merged onto them. The changed papers are also appended to raw.jsonl when there is one,
+    so that the next crawl compacts the new parse into raw.json
+    :param workers: number of processes, defaults to the number of cores
+    :param cache_dir: folder with pages, accepted, rejected and raw.json
+    :param base_url: OpenReview url the links are built from
+    :param chunksize: pages sent to a process at once
+    :return: dict of title -> paper
+    """
+    cache_dir = Path(cache_dir)
+    res = {}
+    if (cache_dir / "raw.json").exists():
+        with open(cache_dir / "raw.json", 'r') as f:
+            res = json.load(f)
+    pages = list((cache_dir / 'pages').glob("NeurIPS*.html"))
+    for is_accepted in [True, False]:
+        for page in [p for p in pages if ('reject' not in p.name) == is_accepted]:
+            with open(page, 'r') as f:
+                for paper in listed_papers(f.read(), is_accepted=is_accepted):
+                    meta = paper_meta(paper, is_accepted=is_accepted, base_url=base_url)
+                    res.setdefault(meta['title'], {}).update(meta)
+
+    items = []
+    for is_accepted in [True, False]:
+        for path in sorted((cache_dir / ('accepted' if is_accepted else 'rejected')).glob("*.html")):
+            res.setdefault(path.stem, {'title': path.stem, 'is_accepted': is_accepted})
+            items.append((path.stem, path))
+    cached = set(title for title, _ in items)
+    missing = [t for t in res if t not in cached]
+    if missing:
+        print("{} papers have no cached forum page and keep their previous fields".format(len(missing)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        fields = executor.map(_parse_cached, [p for _, p in items], chunksize=chunksize)
+        for (title, _), paper_res in tqdm(zip(items, fields), total=len(items)):
+            res[title].update(paper_res)
+
+    with open(cache_dir / "raw.json", 'w') as f:
         json.dump(res, f, indent=4)
+    if (cache_dir / "raw.jsonl").exists():
+        with RawStore(cache_dir / "raw.jsonl") as store:
+            # only the papers the new parse changed, the store does not grow by a copy per re-extraction
+            stored = store.load()
+            for title, paper in res.items():
+                if stored.get(title) != paper:
+                    store.append({title: paper})
+            print("{} papers changed in raw.jsonl".format(store.appended))
+    return res
 
 
 if __name__ == '__main__':
@@ -275,3 +767,4 @@ if __name__ == '__main__':
     cache_folder.mkdir(exist_ok=True)
     get_neurips_pages()
     extract_neurips_main_pages()
+    # reextract_raw()
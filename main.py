@@ -1,34 +1,28 @@
+import time
+
+_import_start = time.perf_counter()
+
 import os
 import string
 import random
-import time
 import sqlite3
 import json
-import openai
+import argparse
+import importlib
 from pathlib import Path
 from datetime import datetime
 import dataclasses
 import re
+import threading
+import hashlib
+import zlib
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from tqdm import tqdm
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import stats
-
-from langchain.document_loaders import TextLoader
-from langchain.docstore.document import Document
-from langchain.document_loaders.pdf import UnstructuredPDFLoader
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
-
-from langchain.llms import OpenAI
-from langchain.chains.llm import LLMChain
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import RetrievalQA, ConversationalRetrievalChain
-from langchain import PromptTemplate
-from langchain.chains.summarize import load_summarize_chain
-from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+
+# openai, langchain, pandas, matplotlib and scipy take seconds to import, they are imported by the functions using
+# them so that each command of the CLI only pays for its own dependencies
 
 API_MAX_RETRY = 16
 API_RETRY_SLEEP = 10
@@ -44,46 +38,884 @@ prompt_template = \
     Question: {question}
     The possible review answer:"""
 
-PROMPT = PromptTemplate(
-    template=prompt_template, input_variables=["context", "question"]
-)
-
-os.environ["OPENAI_API_KEY"] = ""
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# openai reads the key from the environment when it is imported
+os.environ.setdefault("OPENAI_API_KEY", "")
 
 chunk_size = 1024
 chunk_overlap = 128
 
 
-def pdf_retriever(pdf_path, embedding_function=OpenAIEmbeddings()):
-    if not isinstance(pdf_path, Path):
-        pdf_path = Path(pdf_path)
-    loader = UnstructuredPDFLoader(pdf_path.as_posix())
-
-    db_path = Path(f'db/{pdf_path.name}')
-    pdf_path.parent.mkdir(exist_ok=True, parents=True)
-    if not db_path.exists():
-        print(f'Creating db at {db_path}')
-        documents = loader.load()
-        text_splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        texts = text_splitter.split_documents(documents)
-        db = Chroma.from_documents(texts, embedding_function, persist_directory=db_path.as_posix())
-        db.persist()
-    else:
-        print(f'Loading db from {db_path}')
-        db = Chroma(persist_directory=db_path.as_posix(), embedding_function=embedding_function)
+def num_tokens(text, model_name='gpt-3.5-turbo'):
+    """
+    Count the tokens of a text, falling back to a rough estimate (4 chars per token) without tiktoken
+    :param text: text to count
+    :param model_name: OpenAI model name
+    :return: number of tokens
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return len(text) // 4 + 1
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding('cl100k_base')
+    return len(encoding.encode(text))
+
+
+class RateLimiter:
+    """
+    Thread-safe requests-per-minute / tokens-per-minute budget over a sliding window of 60 seconds
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        """
+        Block until the request fits into the budget
+        :param tokens: estimated tokens of the request
+        :return: None
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.window and self.window[0][0] <= now - 60:
+                    self.window.popleft()
+                used = sum(x[1] for x in self.window)
+                rpm_ok = self.rpm is None or len(self.window) < self.rpm
+                # a single request larger than the whole budget is let through on an empty window
+                tpm_ok = self.tpm is None or used + tokens <= self.tpm or not self.window
+                if rpm_ok and tpm_ok:
+                    self.window.append((now, tokens))
+                    return
+                wait = self.window[0][0] + 60 - now
+            time.sleep(max(wait, 0.01))
+
+
+class RequestExecutor:
+    """
+    Shared executor of OpenAI requests: bounded exponential backoff with full jitter honoring Retry-After,
+    a circuit breaker over consecutive failures, an optional RateLimiter and per-error-class metrics
+    """
+
+    def __init__(self, max_retries=API_MAX_RETRY, base_sleep=1.0, max_sleep=API_RETRY_SLEEP, limiter=None,
+                 breaker_threshold=8, breaker_cooldown=30.0):
+        """
+        :param max_retries: retries of a request before giving up
+        :param base_sleep: first backoff in seconds, doubled on every retry
+        :param max_sleep: upper bound of a single backoff, unless the server asks for longer with Retry-After
+        :param limiter: RateLimiter shared by all requests of this executor
+        :param breaker_threshold: consecutive failures that open the circuit breaker
+        :param breaker_cooldown: seconds the breaker stays open before a probe request is let through
+        """
+        self.max_retries = max_retries
+        self.base_sleep = base_sleep
+        self.max_sleep = max_sleep
+        self.limiter = limiter
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.state = 'closed'
+        self.open_until = 0.0
+        self.counts = Counter()
+
+    @staticmethod
+    def retryable(e):
+        import openai
+        return isinstance(e, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                              openai.error.APIError, openai.error.APIConnectionError,
+                              openai.error.Timeout, openai.error.TryAgain))
+
+    @staticmethod
+    def retry_after(e):
+        headers = getattr(e, 'headers', None) or {}
+        try:
+            return float(headers.get('retry-after') or headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def backoff(self, attempt, e=None):
+        sleep = random.uniform(0, min(self.max_sleep, self.base_sleep * 2 ** attempt))
+        retry_after = self.retry_after(e) if e is not None else None
+        return max(sleep, retry_after) if retry_after is not None else sleep
+
+    def _wait_breaker(self):
+        # half-open: a single probe request goes through after the cooldown, the others keep waiting
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.state == 'closed':
+                    return
+                if self.state == 'open' and now >= self.open_until:
+                    self.state = 'half_open'
+                    return
+                wait = self.open_until - now if self.state == 'open' else 0.5
+            time.sleep(max(wait, 0.05))
+
+    def _record(self, e=None):
+        with self.lock:
+            if e is None:
+                self.counts['success'] += 1
+                self.consecutive_failures = 0
+                self.state = 'closed'
+                return
+            self.counts[type(e).__name__] += 1
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.breaker_threshold:
+                if self.state != 'open':
+                    self.counts['breaker_open'] += 1
+                self.state = 'open'
+                self.open_until = time.monotonic() + self.breaker_cooldown
+
+    def call(self, fn, *args, tokens=0, **kwargs):
+        """
+        Run a request with retries
+        :param fn: function doing the request, e.g. openai.ChatCompletion.create or chain.run
+        :param tokens: estimated tokens of the request for the rate limiter
+        :return: result of fn, the last error is raised once the retries are exhausted
+        """
+        for attempt in range(self.max_retries + 1):
+            self._wait_breaker()
+            if self.limiter is not None:
+                self.limiter.acquire(tokens)
+            try:
+                res = fn(*args, **kwargs)
+            except Exception as e:
+                if not self.retryable(e):
+                    # e.g. an invalid request, retrying would not help and it says nothing about the service
+                    with self.lock:
+                        self.counts[type(e).__name__] += 1
+                        if self.state == 'half_open':
+                            # give the probe back, the next request probes again as the cooldown is over
+                            self.state = 'open'
+                    raise
+                self._record(e)
+                if attempt == self.max_retries:
+                    with self.lock:
+                        self.counts['gave_up'] += 1
+                    raise
+                sleep = self.backoff(attempt, e)
+                with self.lock:
+                    self.counts['retries'] += 1
+                print(f"OpenAI API request failed ({type(e).__name__}: {e}), retrying in {sleep:.1f}s")
+                time.sleep(sleep)
+                continue
+            self._record()
+            return res
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+api_executor = RequestExecutor()
+
+
+class ResultStore:
+    """
+    Append-only JSONL result store, one line per completed paper: {"paper": name, "index": i, "result": {...}}
+    A result only holds the generated fields of the paper (e.g. ai_sum_meta), the crawled ones stay in raw.json.
+    """
+
+    def __init__(self, path, fsync_every=1):
+        """
+        :param path: path of the .jsonl file
+        :param fsync_every: fsync after every N appended records, 0 to leave flushing to the OS
+        """
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.f = open(self.path, 'a')
+
+    def append(self, paper_name, result, index=None):
+        line = json.dumps({'paper': paper_name, 'index': index, 'result': result})
+        with self.lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+            self.pending += 1
+            if self.fsync_every and self.pending >= self.fsync_every:
+                os.fsync(self.f.fileno())
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if not self.f.closed:
+                self.f.flush()
+                os.fsync(self.f.fileno())
+                self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def result_path(name):
+    """
+    Resolve a result file under cache/, preferring the live .jsonl store over a compacted or legacy .json
+    :param name: file name, e.g. gen_gpt-3.5-turbo-16k.json
+    :return: Path
+    """
+    path = Path('cache') / name
+    if path.with_suffix('.jsonl').exists():
+        path = path.with_suffix('.jsonl')
+    return path
+
+
+def generated_fields(paper, raw_paper):
+    """
+    Fields of a result paper that are not in its crawled raw.json entry, e.g. ai_sum_meta and ai_explain
+    """
+    return {k: v for k, v in paper.items() if k not in raw_paper}
+
+
+def load_records(path):
+    """
+    Load the records of a result file as stored, without merging them onto raw.json
+    :param path: result file
+    :return: dict of paper name -> fields, in index order
+    """
+    path = Path(path)
+    if path.suffix != '.jsonl':
+        return json.load(path.open())
+
+    records = {}
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a torn last line after a crash
+                continue
+            # fields accumulate over the records of a paper, later ones win, e.g. re-generated or explained afterwards
+            if record['paper'] in records:
+                old = records[record['paper']]
+                record['result'] = {**old['result'], **record['result']}
+                record['index'] = record['index'] if record['index'] is not None else old['index']
+            records[record['paper']] = record
+    records = sorted(records.values(), key=lambda x: (x['index'] is None, x['index'] or 0))
+    return {r['paper']: r['result'] for r in records}
+
+
+def load_results(path, raw=None):
+    """
+    Load results in the legacy shape from either the legacy .json dict or the .jsonl store,
+    whose generated fields are merged onto the crawled papers of raw.json
+    :param path: result file
+    :param raw: crawled papers, loaded from cache/raw.json if not given
+    :return: dict of paper name -> paper info, in index order
+    """
+    path = Path(path)
+    records = load_records(path)
+    if path.suffix != '.jsonl':
+        return records
+    if raw is None:
+        raw = json.load((Path('cache') / 'raw.json').open())
+    return {k: {**raw.get(k, {}), **v} for k, v in records.items()}
+
+
+def compact_results(path, dst_path=None):
+    """
+    Compact a .jsonl store into the legacy .json shape
+    :param path: .jsonl store
+    :param dst_path: output .json path, default to the same stem
+    :return: output path
+    """
+    path = Path(path)
+    dst_path = Path(dst_path) if dst_path else path.with_suffix('.json')
+    res = load_results(path)
+    with open(dst_path, 'w') as f:
+        json.dump(res, f, indent=4)
+    print('Compacted {} papers to {}'.format(len(res), dst_path.name))
+    return dst_path
+
+
+def dedup_results(name, remove=False):
+    """
+    Convert a legacy result .json, which repeats the crawled reviews of every paper, into a .jsonl store holding
+    only the generated fields; load_results merges them back onto raw.json
+    :param name: result file name, e.g. gen_gpt-3.5-turbo-16k.json
+    :param remove: remove the legacy .json afterwards
+    :return: .jsonl store path
+    """
+    path = Path('cache') / name
+    store_path = path.with_suffix('.jsonl')
+    assert not store_path.exists(), '{} exists already'.format(store_path.name)
+
+    raw = json.load((Path('cache') / 'raw.json').open())
+    res = json.load(path.open())
+    with ResultStore(store_path, fsync_every=0) as store:
+        for idx, (k, v) in enumerate(res.items()):
+            store.append(k, generated_fields(v, raw.get(k, {})), index=idx)
+    print('Deduplicated {} ({} KB) to {} ({} KB)'.format(
+        path.name, path.stat().st_size // 1024, store_path.name, store_path.stat().st_size // 1024))
+
+    if remove:
+        path.unlink()
+    return store_path
+
+
+def config_hash(*parts):
+    """
+    Short hash of a prompt configuration, used to tell whether a stored result is still valid
+    :param parts: json-serializable parts, e.g. model name and prompt template
+    :return: hex digest
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class Manifest:
+    """
+    Append-only progress manifest next to a result store, e.g. gen_gpt-3.5-turbo-16k.manifest.jsonl
+    It has one line per run start and one per finished or failed paper, so progress is known without the results.
+    """
+
+    def __init__(self, store_path):
+        self.path = Path(store_path).with_suffix('.manifest.jsonl')
+        self.lock = threading.Lock()
+
+    def _append(self, record):
+        record['time'] = time.time()
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def start(self, field, config, total):
+        self._append({'event': 'start', 'field': field, 'config': config, 'total': total})
+
+    def mark(self, paper_name, field, config, status, error=None):
+        assert status in ['done', 'failed']
+        record = {'paper': paper_name, 'field': field, 'config': config, 'status': status}
+        if error is not None:
+            record['error'] = str(error)
+        self._append(record)
+
+    def read(self):
+        if not self.path.exists():
+            return []
+        records = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return records
+
+    def statuses(self, field, config):
+        """
+        Latest status of each paper for a field generated with the given configuration
+        """
+        res = {}
+        for r in self.read():
+            if r.get('field') == field and r.get('config') == config and 'paper' in r:
+                res[r['paper']] = r['status']
+        return res
+
+    def completed(self, field, config):
+        return {k for k, v in self.statuses(field, config).items() if v == 'done'}
+
+    def last_done(self, field):
+        """
+        Time of the last paper done for a field, None if there is none
+        """
+        times = [r['time'] for r in self.read() if r.get('field') == field and r.get('status') == 'done']
+        return max(times) if times else None
+
+    def progress(self):
+        """
+        Done/pending/failed counts of the latest run of each field
+        :return: dict of field -> counts
+        """
+        records = self.read()
+        runs = {r['field']: r for r in records if r.get('event') == 'start'}
+        res = {}
+        for field, run in runs.items():
+            statuses = self.statuses(field, run['config'])
+            done = sum(1 for x in statuses.values() if x == 'done')
+            failed = sum(1 for x in statuses.values() if x == 'failed')
+            res[field] = {
+                'config': run['config'],
+                'total': run['total'],
+                'done': done,
+                'failed': failed,
+                'pending': max(run['total'] - done - failed, 0),
+            }
+        return res
+
+
+def progress(name):
+    """
+    Report the progress of a generation / explanation run from its manifest only
+    :param name: result file name, e.g. gen_gpt-3.5-turbo-16k.json
+    :return: dict of field -> counts
+    """
+    res = Manifest(result_path(name).with_suffix('.jsonl')).progress()
+    for field, counts in res.items():
+        print('{}: {done}/{total} done, {pending} pending, {failed} failed'.format(field, **counts))
+    return res
+
+
+class ResponseCache:
+    """
+    Persistent LLM response cache in SQLite, keyed by a hash of model, temperature and the rendered messages.
+    The least recently used entries are evicted once the stored responses exceed max_bytes.
+    It also implements the langchain llm_cache interface (lookup / update / clear) for ChatOpenAI chains.
+    """
+
+    def __init__(self, path='cache/llm_cache.db', max_bytes=512 * 1024 * 1024):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path.as_posix(), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_access REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(model, temperature, messages, api_base=None):
+        """
+        :param model: model name
+        :param temperature: sampling temperature
+        :param messages: rendered messages, or any json-serializable prompt
+        :param api_base: API base url the response came from, None for OpenAI
+        :return: sha256 hex digest
+        """
+        payload = {'model': model, 'temperature': temperature, 'messages': messages}
+        if api_base is not None:
+            payload['api_base'] = api_base
+        payload = json.dumps(payload, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        value = json.dumps(value)
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.size -= old[0] if old else 0
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                              (key, value, len(value), time.time()))
+            self.size += len(value)
+            if self.size > self.max_bytes:
+                evicted = []
+                for k, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                    if self.size <= self.max_bytes:
+                        break
+                    evicted.append((k,))
+                    self.size -= size
+                self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': entries,
+            'bytes': self.size,
+        }
+
+    # langchain cache interface, the llm_string holds the model name and temperature of the chat model
+    def lookup(self, prompt, llm_string):
+        from langchain.load.load import loads
+        value = self.get(self.key(llm_string, None, prompt))
+        return [loads(x) for x in value] if value is not None else None
+
+    def update(self, prompt, llm_string, return_val):
+        from langchain.load.dump import dumps
+        self.set(self.key(llm_string, None, prompt), [dumps(x) for x in return_val])
+
+    def clear(self, **kwargs):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+            self.size = 0
+
+
+response_cache = None
+
+
+class ExecutorClient:
+    """
+    Client of a langchain OpenAI model in place of openai.ChatCompletion / openai.Completion, sending its requests
+    through a RequestExecutor. langchain looks its llm_cache up before calling the client, so cache hits are neither
+    throttled by the rate limiter nor counted as requests
+    """
+
+    def __init__(self, client, executor, model_name):
+        self.client = client
+        self.executor = executor
+        self.model_name = model_name
+
+    def create(self, **kwargs):
+        prompt = kwargs.get('messages', kwargs.get('prompt'))
+        return self.executor.call(self.client.create, tokens=num_tokens(json.dumps(prompt), self.model_name),
+                                  **kwargs)
+
+
+def _executor_llm(llm, executor, api_base=None):
+    """
+    Route the requests of a langchain OpenAI model through a RequestExecutor, with the retries left to the executor.
+    The langchain cache is keyed without the API base, so it is bypassed for any other endpoint, e.g. a test server
+    :return: the model
+    """
+    llm.client = ExecutorClient(llm.client, executor, llm.model_name)
+    if api_base is not None:
+        llm.cache = False
+    return llm
+
+
+def enable_response_cache(path='cache/llm_cache.db', max_bytes=512 * 1024 * 1024, langchain_cache=True):
+    """
+    Put a persistent response cache in front of _chatgpt and all langchain chat models
+    :param path: sqlite file
+    :param max_bytes: size bound of the cached responses
+    :param langchain_cache: also set it as the langchain llm_cache, which imports langchain
+    :return: ResponseCache
+    """
+    global response_cache
+    response_cache = ResponseCache(path, max_bytes=max_bytes)
+    if langchain_cache:
+        import langchain
+        langchain.llm_cache = response_cache
+    return response_cache
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache in SQLite in front of a langchain Embeddings, keyed by a hash of the model name and
+    the text, so that re-indexing only embeds the new or changed chunks.
+    It implements embed_documents / embed_query and is passed wherever the wrapped Embeddings would be.
+    """
 
-    retriever = db.as_retriever()
-    return retriever
+    def __init__(self, embeddings, path='cache/embedding_cache.db', model_name=None):
+        """
+        :param embeddings: langchain Embeddings computing the missing vectors
+        :param path: sqlite file
+        :param model_name: part of the key, default to the model of the embeddings, e.g. text-embedding-ada-002
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name or getattr(embeddings, 'model', type(embeddings).__name__)
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path.as_posix(), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.conn.commit()
+
+    def key(self, text, kind='document'):
+        """
+        :param text: embedded text
+        :param kind: 'document' or 'query', which some embedding models embed differently
+        :return: sha256 hex digest
+        """
+        return hashlib.sha256(json.dumps([self.model_name, kind, text]).encode()).hexdigest()
+
+    def _get(self, keys):
+        found = {}
+        with self.lock:
+            # sqlite limits the number of variables of a query
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                found.update(self.conn.execute("SELECT key, vector FROM embeddings WHERE key IN ({})".format(
+                    ','.join('?' * len(batch))), batch).fetchall())
+        return {k: np.frombuffer(v, dtype=np.float64).tolist() for k, v in found.items()}
+
+    def _set(self, items):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                                  [(k, np.asarray(v, dtype=np.float64).tobytes()) for k, v in items])
+            self.conn.commit()
+
+    def embed_documents(self, texts):
+        keys = [self.key(text) for text in texts]
+        vectors = self._get(keys)
+        # identical chunks of the same call are embedded once
+        missing = {k: text for k, text in zip(keys, texts) if k not in vectors}
+        with self.lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            new = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self._set(new.items())
+            vectors.update(new)
+        return [vectors[k] for k in keys]
+
+    def embed_query(self, text):
+        key = self.key(text, kind='query')
+        vectors = self._get([key])
+        with self.lock:
+            self.hits += len(vectors)
+            self.misses += 1 - len(vectors)
+        if not vectors:
+            vectors[key] = self.embeddings.embed_query(text)
+            self._set(vectors.items())
+        return vectors[key]
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': entries,
+            'bytes': size,
+        }
+
+
+def pdf_checksum(pdf_path, chunk=1 << 20):
+    """
+    :param pdf_path: path of the PDF
+    :return: sha256 hex digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
 
-def generate_meta_from_pdf(model_name='gpt-4'):
+def _extract_pdf_text(pdf_path):
+    """
+    Extract the text of a PDF, run in worker processes by extract_pdf_texts
+    """
+    from langchain.document_loaders.pdf import UnstructuredPDFLoader
+    return '\n\n'.join(doc.page_content for doc in UnstructuredPDFLoader(Path(pdf_path).as_posix()).load())
+
+
+class PdfTextCache:
+    """
+    Extracted text of the PDFs in SQLite, zlib-compressed and keyed by the PDF checksum, so a PDF is only parsed once
+    whatever its path, and a revised PDF is parsed again.
+    """
+
+    def __init__(self, path='cache/pdf_text.db'):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path.as_posix(), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS texts (checksum TEXT PRIMARY KEY, text BLOB)")
+        self.conn.commit()
+
+    def checksums(self):
+        with self.lock:
+            return set(row[0] for row in self.conn.execute("SELECT checksum FROM texts"))
+
+    def get(self, checksum):
+        with self.lock:
+            row = self.conn.execute("SELECT text FROM texts WHERE checksum = ?", (checksum,)).fetchone()
+        return zlib.decompress(row[0]).decode() if row is not None else None
+
+    def set(self, checksum, text):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO texts VALUES (?, ?)", (checksum, zlib.compress(text.encode())))
+            self.conn.commit()
+
+    def text(self, pdf_path):
+        """
+        Text of a PDF, extracted in this process if it is not cached yet
+        :param pdf_path: path of the PDF
+        """
+        checksum = pdf_checksum(pdf_path)
+        text = self.get(checksum)
+        if text is None:
+            text = _extract_pdf_text(pdf_path)
+            self.set(checksum, text)
+        return text
+
+
+pdf_text_cache = None
+
+
+def get_pdf_text_cache():
+    global pdf_text_cache
+    if pdf_text_cache is None:
+        pdf_text_cache = PdfTextCache()
+    return pdf_text_cache
+
+
+def extract_pdf_texts(pdf_paths=None, workers=None, cache=None):
+    """
+    Extract the text of the PDFs missing from the text cache on a process pool.
+    Texts are cached as soon as each PDF is done, and a PDF failing to parse is reported and skipped
+    :param pdf_paths: PDF paths, default to cache/*/*.pdf
+    :param workers: number of processes, default to the number of cores
+    :param cache: PdfTextCache, default to the one under cache/
+    :return: dict of pdf path -> checksum of the PDFs whose text is cached
+    """
+    cache = cache or get_pdf_text_cache()
+    if pdf_paths is None:
+        pdf_paths = sorted(Path('cache').glob('*/*.pdf'))
+    checksums = {Path(p): pdf_checksum(p) for p in pdf_paths}
+    done = cache.checksums()
+    # one extraction per distinct PDF
+    todo = {}
+    for pdf_path, checksum in checksums.items():
+        if checksum not in done:
+            todo.setdefault(checksum, pdf_path)
+    failed = set()
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_extract_pdf_text, pdf_path): checksum for checksum, pdf_path in todo.items()}
+            for future in tqdm(as_completed(futures), desc='Extracting', total=len(futures)):
+                try:
+                    cache.set(futures[future], future.result())
+                except Exception as e:
+                    print('Failed to extract {}: {}'.format(todo[futures[future]], e))
+                    failed.add(futures[future])
+    print('Extracted {} PDFs, {} cached already or duplicated, {} failed'.format(
+        len(todo) - len(failed), len(checksums) - len(todo), len(failed)))
+    return {p: c for p, c in checksums.items() if c not in failed}
+
+
+def pdf_chunks(pdf_path):
+    """
+    Split the cached text of a PDF into the chunks that are embedded
+    :param pdf_path: path of the PDF
+    :return: list of Document
+    """
+    from langchain.docstore.document import Document
+    from langchain.text_splitter import CharacterTextSplitter
+
+    documents = [Document(page_content=get_pdf_text_cache().text(pdf_path),
+                          metadata={'source': Path(pdf_path).as_posix()})]
+    text_splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text_splitter.split_documents(documents)
+
+
+class PaperIndex:
+    """
+    Corpus-wide Chroma index of the PDF chunks of all papers, each chunk tagged with its paper name (the PDF stem).
+    Papers are only ever added: a paper already in the index is skipped, so ingesting new PDFs is incremental.
+    """
+
+    def __init__(self, path='db/corpus', embedding_function=None, collection_name='papers'):
+        """
+        :param path: persist directory of the index
+        :param embedding_function: langchain Embeddings, default to OpenAIEmbeddings behind the EmbeddingCache
+        :param collection_name: Chroma collection
+        """
+        from langchain.embeddings import OpenAIEmbeddings
+        from langchain.vectorstores import Chroma
+
+        if embedding_function is None:
+            embedding_function = EmbeddingCache(OpenAIEmbeddings())
+        self.embedding_function = embedding_function
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.db = Chroma(collection_name=collection_name, embedding_function=embedding_function,
+                         persist_directory=self.path.as_posix())
+
+    def papers(self):
+        """
+        :return: set of the paper names in the index
+        """
+        return set(m['paper'] for m in self.db.get(include=['metadatas'])['metadatas'])
+
+    def add(self, pdf_paths, batch_size=512):
+        """
+        Chunk and embed the PDFs that are not in the index yet.
+        Chunks of consecutive papers are embedded together, with at least batch_size chunks per add, and a paper is
+        never split across two adds so that an interrupted ingestion leaves no partial paper behind.
+        :param pdf_paths: PDF paths
+        :param batch_size: chunks per embedding batch
+        :return: number of added papers
+        """
+        done = self.papers()
+        todo = [Path(p) for p in pdf_paths if Path(p).stem not in done]
+        texts, metadatas, ids = [], [], []
+
+        def flush():
+            if texts:
+                self.db.add_texts(texts, metadatas=metadatas, ids=ids)
+                texts.clear(), metadatas.clear(), ids.clear()
+
+        for pdf_path in tqdm(todo, desc='Indexing', total=len(todo), disable=len(todo) < 2):
+            for i, doc in enumerate(pdf_chunks(pdf_path)):
+                texts.append(doc.page_content)
+                metadatas.append({'paper': pdf_path.stem})
+                ids.append('{}:{}'.format(pdf_path.stem, i))
+            if len(texts) >= batch_size:
+                flush()
+        flush()
+        self.db.persist()
+        if isinstance(self.embedding_function, EmbeddingCache):
+            print('Embedding cache: {}'.format(self.embedding_function.stats()))
+        return len(todo)
+
+    def retriever(self, paper, k=4):
+        """
+        Retriever over the chunks of a single paper
+        :param paper: paper name, the PDF stem
+        :param k: number of retrieved chunks
+        """
+        return self.db.as_retriever(search_kwargs={'k': k, 'filter': {'paper': paper}})
+
+
+def pdf_retriever(pdf_path, embedding_function=None, index=None):
+    """
+    Retriever over a PDF, added to the corpus index first if needed
+    :param pdf_path: path of the PDF
+    :param embedding_function: langchain Embeddings of a new index
+    :param index: PaperIndex, default to the one under db/corpus
+    """
+    index = index or PaperIndex(embedding_function=embedding_function)
+    index.add([pdf_path])
+    return index.retriever(Path(pdf_path).stem)
+
+
+def generate_meta_from_pdf(model_name='gpt-4', workers=4, resume=False, executor=None, api_base=None):
     """
     Using GPT-4 to generate the review based on paper PDF
+    Each review is appended to cache/NeurIPS2022.jsonl as soon as it is generated, and merged into
+    cache/NeurIPS2022.json at the end
     :param model_name:
+    :param workers: number of papers generated concurrently
+    :param resume: skip papers already generated with the same model and question, according to the manifest
+    :param executor: RequestExecutor, default to the module one
+    :param api_base: OpenAI-compatible API base url
     :return:
     """
-    model = OpenAI(model_name=model_name, temperature=0)
+    from langchain.llms import OpenAI
+    from langchain.chains.question_answering import load_qa_chain
+    from langchain import PromptTemplate
+
+    PROMPT = PromptTemplate(
+        template=prompt_template, input_variables=["context", "question"]
+    )
+    executor = executor or api_executor
+    # retries are left to the executor, so that they share its backoff, breaker and rate budget
+    model = _executor_llm(OpenAI(model_name=model_name, temperature=0, openai_api_base=api_base, max_retries=1),
+                          executor, api_base)
 
     res = Path('cache') / 'NeurIPS2022.json'
     assert res.exists()
@@ -91,73 +923,97 @@ def generate_meta_from_pdf(model_name='gpt-4'):
 
     path_cache = Path('cache')
     pd_list = list(path_cache.glob('*/*.pdf'))
-    for pdf_path in tqdm(pd_list, desc='Processing', total=len(pd_list)):
-        retriever = pdf_retriever(pdf_path)
-        qa = RetrievalQA.from_chain_type(
-            model,
-            retriever=retriever,
-            return_source_documents=True,
-            # chain_type="map_reduce",
-            chain_type="stuff",
-            # chain_type="refine",
-            chain_type_kwargs={"prompt": PROMPT}
-        )
-
-        question_meta_review = (
-            "Give the final meta review. The output should strictly follow the format \"Recommandation: [Reject/Accept]\nCondifence:[Certain/Less Certain]\n[Your review]\". "
-            "The review should be a short summary of explanation, such as the strengths and weaknesses of the paper.")
-        ai_meta_review = qa(question_meta_review)['result']
-
-        res[pdf_path.name[:-4]]['ai_meta_question'] = question_meta_review
-        res[pdf_path.name[:-4]]['ai_meta_review'] = ai_meta_review
-
-        questions = [
-            # "Summary and contributions: Briefly summarize the paper and its contributions ",
-            # "Strengths: Describe the strengths of the work. Typical criteria include: soundness of the claims (theoretical grounding, empirical evaluation), significance and novelty of the contribution.",
-            # "Weaknesses: Explain the limitations of this work along the same axes as above. This is like above, but now focussing on the limitations of this work. Your comments should be detailed, specific, and polite. Please avoid vague, subjective complaints. Think about the times when you received an unfair, unjustified, short, or dismissive review. Try not to be that reviewer! Always be constructive and help the authors understand your viewpoint, without being dismissive or using inappropriate language. Remember that you are not reviewing your level of interest in the submission, but its scientific contribution to the field!",
-            # "Correctness: Are the claims and method correct? Is the empirical methodology correct? Explain if there is anything incorrect with the paper. Incorrect claims or methodology are the primary reason for rejection. Be as detailed, specific and polite as possible. Thoroughly motivate your criticism so that authors will understand your point of view and potentially respond to you.",
-            # "Clarity: Is the paper well written? Rate the clarity of exposition of the paper. Give examples of what parts of the paper need revision to improve clarity.",
-            # "Relation to prior work: Is it clearly discussed how this work differs from previous contributions? Explain whether the submission is written with the due scholarship, relating the proposed work with the prior work in the literature. The related work section should not just list prior work, but explain how the proposed work differs from prior work appeared in the literature.",
-            # "Reproducibility: Are there enough details to reproduce the major results of this work? Mark whether the work is reasonably reproducible. If it is not, lack of reproducibility should be listed among the weaknesses of the submission.",
-            # "Additional feedback, comments, suggestions for improvement and questions for the authors. Add here any additional comment you might have about the submission, including questions and suggestions for improvement.",
-            "Give the final meta review and overall score: You should NOT assume that you were assigned a representative sample of submissions, nor should you adjust your scores to match the overall conference acceptance rates. The “Overall Score” for each submission should reflect your assessment of the submission’s contributions. "
-            "Score 10: Top 5% of accepted papers. Truly groundbreaking work. "
-            "Score 9: Top 15% of accepted papers. An excellent submission; a strong accept. "
-            "Score 8: Top 50% of accepted papers. A very good submission; a clear accept. "
-            "Score 7: A good submission; accept. I vote for accepting this submission, although I would not be upset if it were rejected.) "
-            "Score 6: Marginally above the acceptance threshold. I tend to vote for accepting this submission, but rejecting it would not be that bad. "
-            "Score 5: Marginally below the acceptance threshold. I tend to vote for rejecting this submission, but accepting it would not be that bad. "
-            "Score 4: An okay submission, but not good enough; a reject. I vote for rejecting this submission, although I would not be upset if it were accepted. "
-            "Score 3: A clear reject. I vote and argue for rejecting this submission. "
-            "Score 2: I'm surprised this work was submitted; a strong reject. "
-            "Score 1: Trivial or wrong or already known.",
-            # "Confidence score: "
-            # "Score 5: You are absolutely certain about your assessment. You are very familiar with the related work. "
-            # "Score 4: You are confident in your assessment, but not absolutely certain. It is unlikely, but not impossible, that you did not understand some parts of the submission or that you are unfamiliar with some pieces of related work. "
-            # "Score 3: You are fairly confident in your assessment. It is possible that you did not understand some parts of the submission or that you are unfamiliar with some pieces of related work. Math/other details were not carefully checked. "
-            # "Score 2: You are willing to defend your assessment, but it is quite likely that you did not understand central parts of the submission or that you are unfamiliar with some pieces of related work. Math/other details were not carefully checked. "
-            # "Score 1: Your assessment is an educated guess. The submission is not in your area or the submission was difficult to understand. Math/other details were not carefully checked.",
-            # "Have the authors adequately addressed the broader impact of their work, including potential negative ethical and societal implications of their work? Yes, no or only partially. In order to provide a balanced perspective, authors are required to include a statement of the potential broader impact of their work, including its ethical aspects and future societal consequences. Authors should take care to discuss both positive and negative outcomes. Indicate whether you believe the broader impact section was adequate.",
-            # "Does the submission raise potential ethical concerns? This includes methods, applications, or data that create or reinforce unfair bias or that have a primary purpose of harm or injury. If so, please explain briefly. Yes or No. Explain if the submission might raise any potential ethical concern. Note that your rating should be independent of this. If the AC also shares this concern, dedicated reviewers with expertise at the intersection of ethics and ML will further review the submission. Your duty here is to flag only papers that might need this additional revision step.",
-            # "Have you previously reviewed or area chaired (a version of) this work for another archival venue? Yes or No. This information will be useful to ACs and SACs in putting your review details in context of having already seen an earlier version. ACs and SACs have access to a resubmission statement by the authors which declares whether the submission was previously rejected and what changes were made to the current version. The AC may decide to share this information with reviewers if needed.",
-            # "Confidential comments for the area chair. If you have comments that you wish to be kept confidential from the authors, you can use the “Confidential Comments to Area Chair” text field. Such comments might include explicit comparisons of the submission to other submissions and criticisms that are more bluntly stated. If you accidentally find out the identities of the authors, please do not divulge the identities to anyone.",
-        ]
+    # the PDFs are parsed on a process pool, then ingested in one bulk pass, and each paper is a filtered query of
+    # the same index
+    extract_pdf_texts(pd_list)
+    index = PaperIndex()
+    index.add(pd_list)
+    combine_chain = load_qa_chain(
+        model,
+        # chain_type="map_reduce",
+        chain_type="stuff",
+        # chain_type="refine",
+        prompt=PROMPT
+    )
+    question_meta_review = (
+        "Give the final meta review. The output should strictly follow the format \"Recommandation: [Reject/Accept]\nCondifence:[Certain/Less Certain]\n[Your review]\". "
+        "The review should be a short summary of explanation, such as the strengths and weaknesses of the paper.")
+
+    def review(pdf_path):
+        # the retrieval runs on the worker thread, while the LLM calls of other papers are in flight
+        docs = index.retriever(pdf_path.stem).get_relevant_documents(question_meta_review)
+        return combine_chain.run(input_documents=docs, question=question_meta_review)
+
+    store_path = Path('cache') / 'NeurIPS2022.jsonl'
+    indices = {k: i for i, k in enumerate(res)}
+    manifest = Manifest(store_path)
+    config = config_hash(model_name, prompt_template, question_meta_review)
+    done = manifest.completed('ai_meta_review', config) if resume else set()
+    todo = [p for p in pd_list if p.stem not in done]
+    if done:
+        print('Resuming: {} papers done, {} to generate'.format(len(pd_list) - len(todo), len(todo)))
+    manifest.start('ai_meta_review', config, len(pd_list))
+
+    with ResultStore(store_path) as store, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(review, pdf_path): pdf_path.stem for pdf_path in todo}
+        for future in tqdm(as_completed(futures), desc='Processing', total=len(futures)):
+            paper_name = futures[future]
+            try:
+                ai_meta_review = future.result()
+            except Exception as e:
+                print(f"Failed to generate {paper_name}: {e}")
+                manifest.mark(paper_name, 'ai_meta_review', config, 'failed', error=e)
+                continue
+            store.append(paper_name, {'ai_meta_question': question_meta_review, 'ai_meta_review': ai_meta_review},
+                         index=indices.get(paper_name))
+            manifest.mark(paper_name, 'ai_meta_review', config, 'done')
+
+    questions = [
+        # "Summary and contributions: Briefly summarize the paper and its contributions ",
+        # "Strengths: Describe the strengths of the work. Typical criteria include: soundness of the claims (theoretical grounding, empirical evaluation), significance and novelty of the contribution.",
+        # "Weaknesses: Explain the limitations of this work along the same axes as above. This is like above, but now focussing on the limitations of this work. Your comments should be detailed, specific, and polite. Please avoid vague, subjective complaints. Think about the times when you received an unfair, unjustified, short, or dismissive review. Try not to be that reviewer! Always be constructive and help the authors understand your viewpoint, without being dismissive or using inappropriate language. Remember that you are not reviewing your level of interest in the submission, but its scientific contribution to the field!",
+        # "Correctness: Are the claims and method correct? Is the empirical methodology correct? Explain if there is anything incorrect with the paper. Incorrect claims or methodology are the primary reason for rejection. Be as detailed, specific and polite as possible. Thoroughly motivate your criticism so that authors will understand your point of view and potentially respond to you.",
+        # "Clarity: Is the paper well written? Rate the clarity of exposition of the paper. Give examples of what parts of the paper need revision to improve clarity.",
+        # "Relation to prior work: Is it clearly discussed how this work differs from previous contributions? Explain whether the submission is written with the due scholarship, relating the proposed work with the prior work in the literature. The related work section should not just list prior work, but explain how the proposed work differs from prior work appeared in the literature.",
+        # "Reproducibility: Are there enough details to reproduce the major results of this work? Mark whether the work is reasonably reproducible. If it is not, lack of reproducibility should be listed among the weaknesses of the submission.",
+        # "Additional feedback, comments, suggestions for improvement and questions for the authors. Add here any additional comment you might have about the submission, including questions and suggestions for improvement.",
+        "Give the final meta review and overall score: You should NOT assume that you were assigned a representative sample of submissions, nor should you adjust your scores to match the overall conference acceptance rates. The “Overall Score” for each submission should reflect your assessment of the submission’s contributions. "
+        "Score 10: Top 5% of accepted papers. Truly groundbreaking work. "
+        "Score 9: Top 15% of accepted papers. An excellent submission; a strong accept. "
+        "Score 8: Top 50% of accepted papers. A very good submission; a clear accept. "
+        "Score 7: A good submission; accept. I vote for accepting this submission, although I would not be upset if it were rejected.) "
+        "Score 6: Marginally above the acceptance threshold. I tend to vote for accepting this submission, but rejecting it would not be that bad. "
+        "Score 5: Marginally below the acceptance threshold. I tend to vote for rejecting this submission, but accepting it would not be that bad. "
+        "Score 4: An okay submission, but not good enough; a reject. I vote for rejecting this submission, although I would not be upset if it were accepted. "
+        "Score 3: A clear reject. I vote and argue for rejecting this submission. "
+        "Score 2: I'm surprised this work was submitted; a strong reject. "
+        "Score 1: Trivial or wrong or already known.",
+        # "Confidence score: "
+        # "Score 5: You are absolutely certain about your assessment. You are very familiar with the related work. "
+        # "Score 4: You are confident in your assessment, but not absolutely certain. It is unlikely, but not impossible, that you did not understand some parts of the submission or that you are unfamiliar with some pieces of related work. "
+        # "Score 3: You are fairly confident in your assessment. It is possible that you did not understand some parts of the submission or that you are unfamiliar with some pieces of related work. Math/other details were not carefully checked. "
+        # "Score 2: You are willing to defend your assessment, but it is quite likely that you did not understand central parts of the submission or that you are unfamiliar with some pieces of related work. Math/other details were not carefully checked. "
+        # "Score 1: Your assessment is an educated guess. The submission is not in your area or the submission was difficult to understand. Math/other details were not carefully checked.",
+        # "Have the authors adequately addressed the broader impact of their work, including potential negative ethical and societal implications of their work? Yes, no or only partially. In order to provide a balanced perspective, authors are required to include a statement of the potential broader impact of their work, including its ethical aspects and future societal consequences. Authors should take care to discuss both positive and negative outcomes. Indicate whether you believe the broader impact section was adequate.",
+        # "Does the submission raise potential ethical concerns? This includes methods, applications, or data that create or reinforce unfair bias or that have a primary purpose of harm or injury. If so, please explain briefly. Yes or No. Explain if the submission might raise any potential ethical concern. Note that your rating should be independent of this. If the AC also shares this concern, dedicated reviewers with expertise at the intersection of ethics and ML will further review the submission. Your duty here is to flag only papers that might need this additional revision step.",
+        # "Have you previously reviewed or area chaired (a version of) this work for another archival venue? Yes or No. This information will be useful to ACs and SACs in putting your review details in context of having already seen an earlier version. ACs and SACs have access to a resubmission statement by the authors which declares whether the submission was previously rejected and what changes were made to the current version. The AC may decide to share this information with reviewers if needed.",
+        # "Confidential comments for the area chair. If you have comments that you wish to be kept confidential from the authors, you can use the “Confidential Comments to Area Chair” text field. Such comments might include explicit comparisons of the submission to other submissions and criticisms that are more bluntly stated. If you accidentally find out the identities of the authors, please do not divulge the identities to anyone.",
+    ]
+
+    for k, v in load_records(store_path).items():
+        if k in res:
+            res[k].update(v)
     with open('cache/NeurIPS2022.json', 'w') as f:
         json.dump(res, f, indent=4)
+    print('API metrics: {}'.format(executor.metrics()))
 
 
-def generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=None, confidence=None, score=True):
+def _load_papers():
     """
-    Use GPT to generate the summary (meta review) from other human reviews
-    :param model_name: OpenAI model name
-    :param strictness: float number between 0 and 1, higher is stricter
-    :param confidence: 'Certain' or 'Less Certain'
-    :param score: whether to use include the score of reviewers, for ablation study
-    :return: generated meta review
+    Load the crawled papers of raw.json whose PDF is cached
+    :return: dict of paper name -> paper info
     """
-
     src_path = Path('cache') / 'raw.json'
-    dst_path = Path('cache') / 'gen_{}.json'.format(model_name)
 
     assert src_path.exists()
     res = json.load(src_path.open())
@@ -167,6 +1023,16 @@ def generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=None,
     reject_folder = list((Path('cache') / 'rejected').glob('*.pdf'))
     names_existed = [x.stem for x in accept_folder + reject_folder]
     res = {k: v for k, v in res.items() if k in names_existed}
+    return res
+
+
+def _meta_prompt(model_name='gpt-3.5-turbo-16k', strictness=None, confidence=None, score=True, digest=False):
+    """
+    Build the meta review prompt template of a generation setting and its output path
+    :param digest: the reviews are given as digests, see digest_reviews
+    :return: prompt template with a {text} variable, output .json path
+    """
+    dst_path = Path('cache') / 'gen_{}.json'.format(model_name)
 
     prompt_template = "Please act as a meta reviewer to give the final metareview based on reviews from other reviewers."
 
@@ -186,6 +1052,9 @@ def generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=None,
     if not score:
         dst_path = dst_path.parent / (dst_path.stem + '_NoScore.json')
 
+    if digest:
+        dst_path = dst_path.parent / (dst_path.stem + '_digest.json')
+
     prompt_template += """
       Feel free to express the possible opinions.
       
@@ -203,34 +1072,580 @@ def generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=None,
       
       (Note there is no "weak" or "borderline" recommendation.)
       """
+    return prompt_template, dst_path
+
+
+def _review_text(paper, score=True):
+    """
+    Join the human reviews of a paper into the {text} of the meta review prompt
+    :param paper: paper info
+    :param score: whether to keep the scores of reviewers
+    :return: text
+    """
+    reviews = paper['reviews']
+    if not score:
+        new_reviews = []
+        for r in reviews:
+            new_reviews.append(
+                r.split('Rating:')[0].strip() + '\nConfidence:' + r.split('Confidence:')[1].strip()
+            )
+        reviews = new_reviews
+    return '\n'.join(reviews)
+
+
+class TokenCounts:
+    """
+    Persistent cache of token counts, keyed by a hash of the counting method, the model name and the text,
+    so that the estimates of num_tokens without tiktoken are not taken for real counts once it is installed
+    """
+
+    def __init__(self, path='cache/token_counts.json'):
+        import importlib.util
+        self.path = Path(path)
+        self.counts = json.load(self.path.open()) if self.path.exists() else {}
+        self.method = 'tiktoken' if importlib.util.find_spec('tiktoken') else 'estimate'
+        self.new = 0
+        self.lock = threading.Lock()
+
+    def count(self, text, model_name='gpt-3.5-turbo'):
+        key = hashlib.sha1(json.dumps([self.method, model_name, text]).encode()).hexdigest()
+        if key not in self.counts:
+            n = num_tokens(text, model_name)
+            with self.lock:
+                self.counts[key] = n
+                self.new += 1
+        return self.counts[key]
+
+    def save(self):
+        with self.lock:
+            if self.new:
+                self.path.parent.mkdir(exist_ok=True, parents=True)
+                with open(self.path, 'w') as f:
+                    json.dump(self.counts, f)
+                self.new = 0
+
+
+token_counts = None
+
+
+def get_token_counts():
+    global token_counts
+    if token_counts is None:
+        token_counts = TokenCounts()
+    return token_counts
+
+# review fields without any signal for the meta review
+BOILERPLATE_FIELDS = ('Code Of Conduct', 'Ethics Flag', 'Ethics Review Area')
+
+
+@dataclasses.dataclass
+class CompactionPolicy:
+    """
+    How the human reviews of a paper are compacted into the meta review prompt
+    budget: prompt tokens a request should fit in
+    drop_fields: review fields always left out, as they carry no signal for the meta review
+    trim_order: review fields left out in this order, lowest priority first, while the prompt is over budget.
+    Reviews are truncated evenly if the prompt is still over budget without them.
+    """
+    budget: int = 12000
+    drop_fields: tuple = BOILERPLATE_FIELDS
+    trim_order: tuple = ('Limitations', 'Questions', 'Summary')
+
+
+SCORE_FIELDS = ('Soundness', 'Presentation', 'Contribution', 'Rating', 'Confidence')
+
+
+def _review_fields_text(reviews):
+    # same layout as the reviews crawled into raw.json
+    return '\n'.join('Reviewer {}: \n'.format(idx_r + 1) + '\n'.join('{}: {}'.format(k, v) for k, v in r.items())
+                     + '\n\n' for idx_r, r in enumerate(reviews))
+
+
+def compact_review_text(paper, prompt_template, model_name, score=True, policy=None, counter=None):
+    """
+    Review text of a paper compacted by a policy so that its prompt fits the token budget
+    :param paper: paper info with reviews_parsed
+    :param prompt_template: meta review prompt template with a {text} variable
+    :param model_name: OpenAI model name, for counting tokens
+    :param score: whether to keep the scores of reviewers
+    :param policy: CompactionPolicy, None to keep the full text of _review_text
+    :param counter: TokenCounts, default to the module one
+    :return: text, number of prompt tokens
+    """
+    counter = counter or get_token_counts()
+    # the prompt count is the template count plus the text count, so that text counts are shared by all settings
+    overhead = counter.count(prompt_template.format(text=''), model_name)
+    text = _review_text(paper, score)
+    if policy is None:
+        return text, overhead + counter.count(text, model_name)
+
+    drop = set(policy.drop_fields) | (set() if score else {'Rating'})
+    reviews = [{k: v for k, v in r.items() if k not in drop} for r in paper.get('reviews_parsed', [])]
+    if reviews:
+        text = _review_fields_text(reviews)
+    for field in policy.trim_order:
+        if overhead + counter.count(text, model_name) <= policy.budget or not reviews:
+            break
+        reviews = [{k: v for k, v in r.items() if k != field} for r in reviews]
+        text = _review_fields_text(reviews)
+    tokens = overhead + counter.count(text, model_name)
+    for _ in range(5):
+        if tokens <= policy.budget or tokens <= overhead:
+            break
+        # cut the same share of every free-text field, the scores are kept
+        ratio = 0.95 * max(policy.budget - overhead, 0) / (tokens - overhead)
+        if reviews:
+            reviews = [{k: v if k in SCORE_FIELDS else v[:int(len(v) * ratio)] for k, v in r.items()} for r in reviews]
+            text = _review_fields_text(reviews)
+        else:
+            text = text[:int(len(text) * ratio)]
+        tokens = overhead + counter.count(text, model_name)
+    return text, tokens
+
+
+DIGEST_PROMPT = (
+    "Condense the peer review below into a short digest for a meta reviewer. "
+    "Keep its main points, in the reviewer's opinion, without adding anything. Follow the format:\n"
+    "Summary: [one sentence]\n"
+    "Strengths: [up to 3 short points]\n"
+    "Weaknesses: [up to 3 short points]\n"
+    "Questions: [the key questions to the authors, if any]\n\n"
+    "[The Start of Review]\n{review}\n[The End of Review]\n")
+
+
+class ReviewDigests:
+    """
+    Review digests in a ResultStore, one record per review: {"paper": key, "result": {"digest": ...}}, keyed by a hash
+    of the digest model, the digest prompt and the review text, so a review is digested once for every setting of a
+    sweep.
+    """
+
+    def __init__(self, path='cache/review_digests.jsonl'):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.digests = {k: v['digest'] for k, v in load_records(self.path).items()} if self.path.exists() else {}
+        self.store = ResultStore(self.path)
+
+    @staticmethod
+    def key(model_name, review):
+        return hashlib.sha256(json.dumps([model_name, DIGEST_PROMPT, review]).encode()).hexdigest()
+
+    def get(self, key):
+        return self.digests.get(key)
+
+    def put(self, key, digest):
+        self.store.append(key, {'digest': digest})
+        self.digests[key] = digest
+
+
+review_digests = None
+
+
+def get_review_digests():
+    global review_digests
+    if review_digests is None:
+        review_digests = ReviewDigests()
+    return review_digests
+
+
+def _review_free_text(review):
+    # what a digest is made from: the written fields, the scores are added back verbatim
+    return '\n'.join('{}: {}'.format(k, v) for k, v in review.items() if
+                     k not in SCORE_FIELDS and k not in BOILERPLATE_FIELDS)
+
+
+def digest_reviews(papers, model_name='gpt-3.5-turbo-16k', workers=8, executor=None, api_base=None, store=None):
+    """
+    First stage of the two-stage meta review: condense every review not digested yet into a digest
+    :param papers: papers with reviews_parsed
+    :param model_name: OpenAI model name of the digests
+    :param workers: number of reviews digested concurrently
+    :param executor: RequestExecutor, default to the module one
+    :param api_base: OpenAI-compatible API base url
+    :param store: ReviewDigests, default to the one under cache/
+    :return: ReviewDigests
+    """
+    store = store or get_review_digests()
+    reviews = [_review_free_text(r) for v in papers.values() for r in v.get('reviews_parsed', [])]
+    todo = {}
+    for review in reviews:
+        key = store.key(model_name, review)
+        if store.get(key) is None:
+            todo[key] = review
+
+    def digest(item):
+        key, review = item
+        message = _chatgpt(user_prompt=DIGEST_PROMPT.format(review=review), model=model_name, executor=executor,
+                           api_base=api_base)
+        return key, message['content']
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for key, text in tqdm(pool.map(digest, todo.items()), desc='Digesting', total=len(todo)):
+            if text == API_ERROR_OUTPUT:
+                failed += 1
+                continue
+            store.put(key, text)
+    print('Digested {} reviews, {} cached already, {} failed'.format(len(todo) - failed, len(reviews) - len(todo),
+                                                                      failed))
+    return store
+
+
+def digest_text(paper, store, model_name, score=True):
+    """
+    Second stage text of the meta review prompt: the digests of the reviews of a paper with their scores
+    :param paper: paper info with reviews_parsed
+    :param store: ReviewDigests
+    :param model_name: OpenAI model name of the digests
+    :param score: whether to keep the scores of reviewers
+    :return: text
+    """
+    reviews = []
+    for idx_r, r in enumerate(paper.get('reviews_parsed', [])):
+        review = _review_free_text(r)
+        # a review whose digest failed is given whole
+        text = store.get(store.key(model_name, review)) or review
+        # the score and its label, without the description of the scale, e.g. "Rating: 5: Borderline accept"
+        scores = ['{}: {}'.format(k, ':'.join(r[k].split(':')[:2]).split('.')[0]) for k in SCORE_FIELDS if
+                  k in r and (score or k != 'Rating')]
+        reviews.append('Reviewer {}: \n'.format(idx_r + 1) + text.strip() + '\n' + '\n'.join(scores) + '\n\n')
+    return '\n'.join(reviews)
+
+
+def _meta_config(model_name, prompt_template, score, policy=None, digest=False):
+    """
+    Manifest config of a meta review setting
+    """
+    parts = [model_name, prompt_template, score]
+    if policy is not None:
+        parts.append(dataclasses.asdict(policy))
+    if digest:
+        parts.append(DIGEST_PROMPT)
+    return config_hash(*parts)
+
+
+def preflight(model_name='gpt-3.5-turbo-16k', strictness=None, confidence=None, score=True, policy=None,
+              papers=None, counter=None, digests=None):
+    """
+    Tokenize the meta review prompts of all the papers before any request, and report the token distribution with
+    and without compaction
+    :param policy: CompactionPolicy applied to the reviews, None to keep them whole
+    :param papers: papers to prompt, default to _load_papers()
+    :param counter: TokenCounts, default to the module one
+    :param digests: ReviewDigests the prompts are built from instead of the reviews, the policy is then ignored
+    :return: dict of paper name -> review text, dict of paper name -> prompt tokens
+    """
+    counter = counter or get_token_counts()
+    papers = papers if papers is not None else _load_papers()
+    prompt_template, _ = _meta_prompt(model_name, strictness, confidence, score)
+    full = {k: compact_review_text(v, prompt_template, model_name, score, None, counter) for k, v in papers.items()}
+    if digests is not None:
+        label = 'digest'
+        overhead = counter.count(prompt_template.format(text=''), model_name)
+        compacted = {}
+        for k, v in papers.items():
+            text = digest_text(v, digests, model_name, score)
+            compacted[k] = (text, overhead + counter.count(text, model_name))
+    elif policy is not None:
+        label = 'compacted'
+        compacted = {k: compact_review_text(v, prompt_template, model_name, score, policy, counter)
+                     for k, v in papers.items()}
+    else:
+        label = None
+        compacted = full
+    counter.save()
+
+    for label, prompts in [('full', full), (label, compacted)] if label is not None else [('prompt', full)]:
+        tokens = np.array([n for _, n in prompts.values()])
+        if len(tokens) == 0:
+            continue
+        p50, p90, p99 = np.percentile(tokens, [50, 90, 99])
+        line = '{} tokens: total {}, mean {:.0f}, p50 {:.0f}, p90 {:.0f}, p99 {:.0f}, max {}'.format(
+            label, tokens.sum(), tokens.mean(), p50, p90, p99, tokens.max())
+        if policy is not None and digests is None:
+            line += ', over {} budget: {}'.format(policy.budget, int((tokens > policy.budget).sum()))
+        print(line)
+    return {k: text for k, (text, _) in compacted.items()}, {k: n for k, (_, n) in compacted.items()}
+
+
+def generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=None, confidence=None, score=True,
+                               workers=1, rpm=None, tpm=None, api_base=None, compact=False,
+                               resume=False, executor=None, policy=None, digest=False):
+    """
+    Use GPT to generate the summary (meta review) from other human reviews
+    :param model_name: OpenAI model name
+    :param strictness: float number between 0 and 1, higher is stricter
+    :param confidence: 'Certain' or 'Less Certain'
+    :param score: whether to use include the score of reviewers, for ablation study
+    :param workers: number of papers generated concurrently
+    :param rpm: requests-per-minute budget, None for unlimited
+    :param tpm: tokens-per-minute budget (prompt tokens), None for unlimited
+    :param api_base: OpenAI-compatible API base url, e.g. a local fake server for testing
+    :param compact: also write the legacy .json next to the .jsonl store when done
+    :param resume: skip papers already generated with the same model and prompt, according to the manifest
+    :param executor: RequestExecutor shared with other runs, rpm and tpm are then ignored
+    :param policy: CompactionPolicy fitting the reviews of each paper in its token budget, None to send them whole
+    :param digest: two-stage mode, every review is first condensed into a digest cached across settings, and the
+    prompts are built from the digests
+    :return: generated meta review
+    """
+    from langchain import PromptTemplate
+    from langchain.chat_models import ChatOpenAI
+    from langchain.chains.llm import LLMChain
+    from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+    from langchain.docstore.document import Document
+
+    res = _load_papers()
+    prompt_template, dst_path = _meta_prompt(model_name, strictness, confidence, score, digest)
 
     prompt = PromptTemplate.from_template(prompt_template)
 
-    llm = ChatOpenAI(temperature=0, model_name=model_name)
+    executor = executor or RequestExecutor(limiter=RateLimiter(rpm=rpm, tpm=tpm))
+    # retries are left to the executor, so that they share its backoff, breaker and rate budget
+    llm = _executor_llm(ChatOpenAI(temperature=0, model_name=model_name, openai_api_base=api_base, max_retries=1),
+                        executor, api_base)
     llm_chain = LLMChain(llm=llm, prompt=prompt)
     stuff_chain = StuffDocumentsChain(
         llm_chain=llm_chain, document_variable_name="text"
     )
 
-    for paper_name, v in tqdm(res.items(), total=len(res.keys())):
-        reviews = v['reviews']
-        if not score:
-            new_reviews = []
-            for r in reviews:
-                new_reviews.append(
-                    r.split('Rating:')[0].strip() + '\nConfidence:' + r.split('Confidence:')[1].strip()
-                )
-            reviews = new_reviews
-        text = '\n'.join(reviews)
-        docs = [Document(page_content=text, metadata={})]
-        summary = stuff_chain.run(docs)
-        res[paper_name]['ai_sum_meta'] = summary
-        print(summary)
+    digests = digest_reviews(res, model_name, workers=workers, executor=executor, api_base=api_base) if digest else None
+    # all the prompts are counted, and compacted, before the first request
+    texts, _ = preflight(model_name, strictness, confidence, score, policy=policy, papers=res, digests=digests)
+
+    def summarize(paper_name, v):
+        docs = [Document(page_content=texts[paper_name], metadata={})]
+        return paper_name, stuff_chain.run(docs)
+
+    # each paper is appended to the store with its index in raw.json, so loading keeps a deterministic order
+    store_path = dst_path.with_suffix('.jsonl')
+    indices = {k: i for i, k in enumerate(res)}
+
+    manifest = Manifest(store_path)
+    config = _meta_config(model_name, prompt_template, score, policy, digest)
+    done = manifest.completed('ai_sum_meta', config) if resume else set()
+    todo = {k: v for k, v in res.items() if k not in done}
+    if done:
+        print('Resuming: {} papers done, {} to generate'.format(len(res) - len(todo), len(todo)))
+    manifest.start('ai_sum_meta', config, len(res))
+
+    with ResultStore(store_path) as store, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(summarize, paper_name, v): paper_name for paper_name, v in todo.items()}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            paper_name = futures[future]
+            try:
+                _, summary = future.result()
+            except Exception as e:
+                print(f"Failed to generate {paper_name}: {e}")
+                manifest.mark(paper_name, 'ai_sum_meta', config, 'failed', error=e)
+                continue
+            res[paper_name]['ai_sum_meta'] = summary
+            store.append(paper_name, {'ai_sum_meta': summary}, index=indices[paper_name])
+            manifest.mark(paper_name, 'ai_sum_meta', config, 'done')
+            print(summary)
+
+    print('Saved to {}'.format(store_path.name))
+    print('API metrics: {}'.format(executor.metrics()))
+    if response_cache is not None:
+        print('Response cache: {}'.format(response_cache.stats()))
+    if compact:
+        compact_results(store_path, dst_path)
+
+
+class LocalBatchBackend:
+    """
+    Stand-in batch backend running the requests of a batch file right away through a RequestExecutor,
+    e.g. against a local fake chat-completion server. It writes the same output format as the OpenAI Batch API.
+    """
 
-        with open(dst_path, 'w') as f:
-            json.dump(res, f, indent=4)
+    def __init__(self, api_base=None, workers=4, executor=None):
+        self.api_base = api_base
+        self.workers = workers
+        self.executor = executor or api_executor
+        self.outputs = {}
+
+    def submit(self, batch_path):
+        batch_path = Path(batch_path)
+        batch_id = 'local_{}'.format(hashlib.sha1(batch_path.read_bytes()).hexdigest()[:12])
+        out_path = batch_path.with_suffix('.{}.jsonl'.format(batch_id))
+        batch_requests = [json.loads(line) for line in batch_path.open()]
+
+        import openai
+
+        def run(request):
+            try:
+                response = self.executor.call(openai.ChatCompletion.create, api_base=self.api_base,
+                                              **request['body'])
+                return {'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': response},
+                        'error': None}
+            except openai.error.OpenAIError as e:
+                return {'custom_id': request['custom_id'], 'response': None,
+                        'error': {'code': type(e).__name__, 'message': str(e)}}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool, open(out_path, 'w') as f:
+            for line in pool.map(run, batch_requests):
+                f.write(json.dumps(line) + '\n')
+        self.outputs[batch_id] = out_path
+        return batch_id
+
+    def status(self, batch_id):
+        return 'completed' if batch_id in self.outputs else 'failed'
+
+    def download(self, batch_id, out_path):
+        out_path = Path(out_path)
+        out_path.write_bytes(self.outputs[batch_id].read_bytes())
+        return out_path
+
+
+class OpenAIBatchBackend:
+    """
+    OpenAI Batch API backend: upload the batch file, create a batch over 24h and download its output file
+    """
 
-    print('Saved to {}'.format(dst_path.name))
+    def __init__(self, api_base=None, api_key=None, completion_window='24h'):
+        import openai
+        self.api_base = (api_base or openai.api_base).rstrip('/')
+        self.api_key = api_key or openai.api_key
+        self.completion_window = completion_window
+
+    def _request(self, method, path, **kwargs):
+        import requests
+        response = requests.request(method, self.api_base + path,
+                                    headers={'Authorization': 'Bearer {}'.format(self.api_key)}, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def submit(self, batch_path):
+        with open(batch_path, 'rb') as f:
+            file_id = self._request('POST', '/files', data={'purpose': 'batch'},
+                                    files={'file': (Path(batch_path).name, f)}).json()['id']
+        batch = self._request('POST', '/batches', json={
+            'input_file_id': file_id,
+            'endpoint': '/v1/chat/completions',
+            'completion_window': self.completion_window,
+        }).json()
+        return batch['id']
+
+    def status(self, batch_id):
+        return self._request('GET', '/batches/{}'.format(batch_id)).json()['status']
+
+    def download(self, batch_id, out_path):
+        file_id = self._request('GET', '/batches/{}'.format(batch_id)).json()['output_file_id']
+        response = self._request('GET', '/files/{}/content'.format(file_id), stream=True)
+        with open(out_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+        return Path(out_path)
+
+
+def write_meta_batch(model_name='gpt-3.5-turbo-16k', strictness=None, confidence=None, score=True, resume=True):
+    """
+    Render the meta review prompts of a generation setting into a batch request file, one chat completion per paper
+    :param resume: leave out papers already generated with the same prompt
+    :return: batch file path, e.g. cache/batch_gen_gpt-3.5-turbo-16k.jsonl
+    """
+    res = _load_papers()
+    prompt_template, dst_path = _meta_prompt(model_name, strictness, confidence, score)
+    store_path = dst_path.with_suffix('.jsonl')
+    config = _meta_config(model_name, prompt_template, score)
+    done = Manifest(store_path).completed('ai_sum_meta', config) if resume else set()
+
+    batch_path = dst_path.parent / 'batch_{}.jsonl'.format(dst_path.stem)
+    with open(batch_path, 'w') as f:
+        for paper_name, v in res.items():
+            if paper_name in done:
+                continue
+            # same request as the ChatOpenAI chain: the rendered prompt as a single user message
+            messages = [{'role': 'user', 'content': prompt_template.format(text=_review_text(v, score))}]
+            f.write(json.dumps({
+                'custom_id': paper_name,
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': {'model': model_name, 'messages': messages, 'temperature': 0},
+            }) + '\n')
+    return batch_path
+
+
+def ingest_meta_batch(output_path, model_name='gpt-3.5-turbo-16k', strictness=None, confidence=None, score=True):
+    """
+    Append the results of a batch output file to the generation result store, as generate_meta_from_reviews does
+    :param output_path: batch output file
+    :return: result store path
+    """
+    res = _load_papers()
+    prompt_template, dst_path = _meta_prompt(model_name, strictness, confidence, score)
+    store_path = dst_path.with_suffix('.jsonl')
+    indices = {k: i for i, k in enumerate(res)}
+
+    outputs = [json.loads(line) for line in open(output_path)]
+    outputs = sorted(outputs, key=lambda x: indices.get(x['custom_id'], len(indices)))
+
+    manifest = Manifest(store_path)
+    config = _meta_config(model_name, prompt_template, score)
+    manifest.start('ai_sum_meta', config, len(res))
+    with ResultStore(store_path) as store:
+        for output in outputs:
+            paper_name = output['custom_id']
+            if paper_name not in res:
+                continue
+            response = output.get('response') or {}
+            if output.get('error') or response.get('status_code') != 200:
+                manifest.mark(paper_name, 'ai_sum_meta', config, 'failed', error=output.get('error') or response)
+                continue
+            summary = response['body']['choices'][0]['message']['content']
+            store.append(paper_name, {'ai_sum_meta': summary}, index=indices[paper_name])
+            manifest.mark(paper_name, 'ai_sum_meta', config, 'done')
+    print('Saved to {}'.format(store_path.name))
+    return store_path
+
+
+def generate_meta_batch(model_name='gpt-3.5-turbo-16k', strictness=None, confidence=None, score=True,
+                        backend=None, poll_interval=60, compact=False):
+    """
+    Offline variant of generate_meta_from_reviews through a batch backend: render the prompts into a batch file,
+    submit it, poll until done and ingest the results into the same gen_*.jsonl store.
+    The submitted batch id is kept in a state file, so calling it again after an interruption polls the same batch.
+    :param backend: batch backend, default to OpenAIBatchBackend
+    :param poll_interval: seconds between two status polls
+    :param compact: also write the legacy .json when done
+    :return: result store path
+    """
+    backend = backend or OpenAIBatchBackend()
+    _, dst_path = _meta_prompt(model_name, strictness, confidence, score)
+    state_path = dst_path.parent / 'batch_{}.state.json'.format(dst_path.stem)
+
+    state = json.load(state_path.open()) if state_path.exists() else {}
+    if state.get('status') in (None, 'ingested', 'failed', 'expired', 'cancelled'):
+        batch_path = write_meta_batch(model_name, strictness, confidence, score)
+        if batch_path.stat().st_size == 0:
+            print('Nothing to generate for {}'.format(dst_path.stem))
+            return dst_path.with_suffix('.jsonl')
+        state = {'batch_id': backend.submit(batch_path), 'status': 'submitted'}
+        with open(state_path, 'w') as f:
+            json.dump(state, f)
+        print('Submitted batch {} from {}'.format(state['batch_id'], batch_path.name))
+
+    while True:
+        status = backend.status(state['batch_id'])
+        if status in ('completed', 'failed', 'expired', 'cancelled'):
+            break
+        print('Batch {} is {}'.format(state['batch_id'], status))
+        time.sleep(poll_interval)
+
+    state['status'] = status
+    if status == 'completed':
+        output_path = backend.download(
+            state['batch_id'], dst_path.parent / 'batch_{}.output.jsonl'.format(dst_path.stem))
+        store_path = ingest_meta_batch(output_path, model_name, strictness, confidence, score)
+        state['status'] = 'ingested'
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+    if state['status'] != 'ingested':
+        raise RuntimeError('Batch {} ended as {}'.format(state['batch_id'], status))
+
+    if compact:
+        compact_results(store_path, dst_path)
+    return store_path
 
 
 def _chatgpt(
@@ -239,8 +1654,17 @@ def _chatgpt(
         history=None,
         # model="gpt-3.5-turbo"
         model="gpt-4",
-        sleep=1.0,
+        executor=None,
+        api_base=None,
+        validate=None,
 ):
+    """
+    Single chat completion through the shared RequestExecutor
+    :param validate: function telling whether a response is usable, only usable responses are cached and reused
+    :return: assistant message, whose content is API_ERROR_OUTPUT if the request failed after all retries
+    """
+    import openai
+    executor = executor or api_executor
     messages = []
 
     if history:
@@ -251,44 +1675,41 @@ def _chatgpt(
 
     messages.append({"role": "user", "content": user_prompt})
 
-    res = []
+    cache_key = None
+    if response_cache is not None:
+        cache_key = response_cache.key(model, 0, messages, api_base)
+        cached = response_cache.get(cache_key)
+        if cached is not None and (validate is None or validate(cached)):
+            return {"role": "assistant", "content": cached}
+
     try:
-        response = openai.ChatCompletion.create(model=model, messages=messages, temperature=0)
-        res = response['choices'][0]['message']['content']
-        res = {"role": "assistant", "content": res}
-    except openai.error.APIError as e:
-        # Handle API error here, e.g. retry or log
-        print(f"OpenAI API returned an API Error: {e}")
-        pass
-    except openai.error.APIConnectionError as e:
-        # Handle connection error here
-        print(f"Failed to connect to OpenAI API: {e}")
-        pass
-    except openai.error.RateLimitError as e:
-        # Handle rate limit error (we recommend using exponential backoff)
-        print(f"OpenAI API request exceeded rate limit: {e}")
-        pass
-    except openai.error.ServiceUnavailableError as e:
-        # retry
+        response = executor.call(openai.ChatCompletion.create, model=model, messages=messages, temperature=0,
+                                 api_base=api_base, tokens=num_tokens(json.dumps(messages), model))
+    except openai.error.OpenAIError as e:
         print(f"OpenAI API request failed: {e}")
-        time.sleep(sleep)
-        return _chatgpt(sys_prompt=sys_prompt, user_prompt=user_prompt, history=history, model=model, sleep=sleep * 2)
+        return {"role": "assistant", "content": API_ERROR_OUTPUT}
 
-    return res
+    res = response['choices'][0]['message']['content']
+    if cache_key is not None and (validate is None or validate(res)):
+        response_cache.set(cache_key, res)
+    return {"role": "assistant", "content": res}
 
 
-def ai_explainer(name, task="explanation"):
+def _explain_prompt(task="explanation"):
     """
-    Using GPT to judge whether the generated meta review is similar to the real human meta review
-    name: the name of the generated meta review json file
-    :return: None
+    Prompts of an ai_explainer task
+    :param task: 'similarity', 'explanation' or 'judge', both of them in a single JSON response
+    :return: system prompt, question, prompt template with {question}, {answer_a} and {answer_b}
     """
-    assert task in ['similarity', 'explanation']
-
-    res_path = Path('cache') / name
-    assert res_path.exists()
-    res = json.load(res_path.open())
-
+    score_guide = (
+        "Give a similarity score from 0 to 10: final recommendations (acceptance or rejection) is the most important factor, weighting 5 to 7. But confidence, content and explanation are less important, weighting 1 to 2. "
+        "For example, the score should be over 5 if the two have the same recommendation, but not over 5 if they are different. Do not be too strict."
+    )
+    aspect_guide = ("List up to 3 aspects they agree/disagree, focusing on their explanation but not the"
+                    " difference of their final recommendation or confidence. The aspects ([Aspect]) can be 'Novelty',"
+                    " 'Soundness', 'Presentation', 'Contribution', 'Related Work', 'Reproducibility', 'Ethics', "
+                    "'Broader Impact', 'Correctness', 'Clarity', 'Strengths', 'Weaknesses', 'Relation to Prior Work', "
+                    "'Additional Feedback', 'Questions for the Authors', or any other aspects you can give.\n")
     if task == 'similarity':
         sys_prompt = (
             "Please act as an impartial judge and evaluate the similarity of the responses provided by a human meta reviewer (a) and AI reviewer (b) to a submitted paper. "
@@ -300,8 +1721,7 @@ def ai_explainer(name, task="explanation"):
 
         prompt_template = (
             "[User Question]\n{question}\n\n[The Start of Human Meta Review]\n{answer_a}\n[The End of Human Meta Review]\n\n[The Start of AI Meta Review]\n{answer_b}\n[The End of AI Meta Review]\n"
-            "Give a similarity score from 0 to 10: final recommendations (acceptance or rejection) is the most important factor, weighting 5 to 7. But confidence, content and explanation are less important, weighting 1 to 2. "
-            "For example, the score should be over 5 if the two have the same recommendation, but not over 5 if they are different. Do not be too strict."
+            + score_guide
         )
     elif task == 'explanation':
         sys_prompt = (
@@ -309,11 +1729,7 @@ def ai_explainer(name, task="explanation"):
             "by a human meta reviewer (a) and AI reviewer (b) to a submitted paper. "
             "Avoid any position, length and order biases to influence your evaluation. "
         )
-        question = ("List up to 3 aspects they agree/disagree, focusing on their explanation but not the"
-                    " difference of their final recommendation or confidence. The aspects ([Aspect]) can be 'Novelty',"
-                    " 'Soundness', 'Presentation', 'Contribution', 'Related Work', 'Reproducibility', 'Ethics', "
-                    "'Broader Impact', 'Correctness', 'Clarity', 'Strengths', 'Weaknesses', 'Relation to Prior Work', "
-                    "'Additional Feedback', 'Questions for the Authors', or any other aspects you can give.\n"
+        question = (aspect_guide +
                     "Follow the format:\n"
                     "Similarities:"
                     "(Aspect 1): [explanation] \n"
@@ -327,117 +1743,392 @@ def ai_explainer(name, task="explanation"):
         prompt_template = (
             "{question}\n\n[The Start of Human Meta Review]\n{answer_a}\n[The End of Human Meta Review]\n\n[The Start of AI Meta Review]\n{answer_b}\n[The End of AI Meta Review]\n"
         )
+    elif task == 'judge':
+        sys_prompt = (
+            "Please act as an impartial judge and explainer of the responses provided by a human meta reviewer (a) "
+            "and AI reviewer (b) to a submitted paper. You judge whether the AI reviewer is similar to the human one, "
+            "and explain their similarity and difference. "
+            "Avoid any position, length and order biases to influence your evaluation. "
+        )
+        question = (score_guide + "\n" + aspect_guide +
+                    "Answer with a single JSON object and nothing else, with the keys:\n"
+                    '"similarity_score": [score from 0 to 10],\n'
+                    '"similarity_explanation": [explanation of the score],\n'
+                    '"similarities": [up to 3 objects {"aspect": [Aspect], "explanation": [explanation]}],\n'
+                    '"differences": [up to 3 objects {"aspect": [Aspect], "explanation": [explanation]}]\n')
+        prompt_template = (
+            "{question}\n\n[The Start of Human Meta Review]\n{answer_a}\n[The End of Human Meta Review]\n\n[The Start of AI Meta Review]\n{answer_b}\n[The End of AI Meta Review]\n"
+        )
     else:
         raise NotImplemented()
+    return sys_prompt, question, prompt_template
 
-    for k, v in res.items():
-        meta = v['meta_review']
-        ai_meta = v['ai_sum_meta']
-        user_prompt = prompt_template.format(question=question, answer_a=meta, answer_b=ai_meta)
 
-        message = _chatgpt(sys_prompt=sys_prompt, user_prompt=user_prompt)["content"]
-        print('*' * 20)
-        print(message)
-        print('*' * 20)
-        res[k]['ai_explain'] = message
+def parse_judge(message):
+    """
+    Split a judge response into the outputs of the similarity and explanation tasks, in their own formats
+    :param message: JSON response of the judge task, possibly in a code block
+    :return: dict with ai_similarity, ai_similarity_source and ai_explain
+    """
+    judged = json.loads(message[message.find('{'):message.rfind('}') + 1])
 
-    with open(res_path, 'w') as f:
-        json.dump(res, f, indent=4)
+    def aspects(items):
+        return ''.join('({}): {} \n'.format(item['aspect'], item['explanation']) for item in items)
 
+    return {
+        'ai_similarity': 'Similarity Score: {} \n Explanation: {}'.format(judged['similarity_score'],
+                                                                          judged['similarity_explanation']),
+        'ai_similarity_source': 'judge',
+        'ai_explain': 'Similarities:\n' + aspects(judged['similarities']) +
+                      'Differences:\n' + aspects(judged['differences']),
+    }
 
-def analysis(name):
+
+def ai_explainer(name, task="explanation", resume=False, executor=None, api_base=None, workers=4, prefilter=False):
+    """
+    Using GPT to judge whether the generated meta review is similar to the real human meta review
+    name: the name of the generated meta review json file
+    :param task: 'similarity', saved as ai_similarity, 'explanation', saved as ai_explain, or 'judge' for both in a
+    single request per paper
+    :param resume: skip papers already explained with the same task and prompt, according to the manifest
+    :param executor: RequestExecutor shared with other runs, default to the module one
+    :param api_base: OpenAI-compatible API base url
+    :param workers: number of papers explained concurrently
+    :param prefilter: only judge the pairs local_similarity finds ambiguous, the others get their local score as
+    ai_similarity, with ai_similarity_source 'local'
+    :return: None
+    """
+    executor = executor or api_executor
+    assert task in ['similarity', 'explanation', 'judge']
+    assert not prefilter or task != 'explanation'
+
+    res_path = result_path(name)
+    assert res_path.exists()
+    res = load_results(res_path)
+
+    sys_prompt, question, prompt_template = _explain_prompt(task)
+
+    # every explained paper is appended to the .jsonl store, a legacy .json is first converted into one
+    store_path = res_path.with_suffix('.jsonl')
+    if res_path.suffix != '.jsonl':
+        dedup_results(res_path.name)
+    store = ResultStore(store_path)
+
+    field = {'similarity': 'ai_similarity', 'explanation': 'ai_explain', 'judge': 'ai_judge'}[task]
+    manifest = Manifest(store_path)
+    # a prefiltered run is a run of its own, its local scores do not count as judged papers of a full run
+    config = config_hash(task, sys_prompt, question, prompt_template, *(['prefilter'] if prefilter else []))
+    done = manifest.completed(field, config) if resume else set()
+    manifest.start(field, config, len(res))
+    indices = {k: i for i, k in enumerate(res)}
+    todo = [k for k in res if k not in done]
+    if prefilter and todo:
+        import pandas as pd
+        # scored over all the papers, the percentiles do not depend on what is left to judge
+        similarity = local_similarity(pd.Series({k: v['meta_review'] for k, v in res.items()}, dtype=object),
+                                      pd.Series({k: v['ai_sum_meta'] for k, v in res.items()}, dtype=object))
+        ambiguous = [k for k in todo if similarity.at[k, 'ambiguous']]
+        print('Prefilter: judging {} ambiguous pairs out of {}'.format(len(ambiguous), len(todo)))
+        for k in todo:
+            if similarity.at[k, 'ambiguous']:
+                continue
+            result = {'ai_similarity': 'Similarity Score: {:.1f} \n Explanation: local similarity'.format(
+                similarity.at[k, 'score']), 'ai_similarity_source': 'local'}
+            res[k].update(result)
+            store.append(k, result, index=indices[k])
+            manifest.mark(k, field, config, 'done')
+        todo = ambiguous
+
+    def parsable(message):
+        try:
+            parse_judge(message)
+        except (ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def explain(k):
+        v = res[k]
+        user_prompt = prompt_template.format(question=question, answer_a=v['meta_review'], answer_b=v['ai_sum_meta'])
+        # an unparsable judge response is not cached, so that it is requested again on resume
+        message = _chatgpt(sys_prompt=sys_prompt, user_prompt=user_prompt, executor=executor, api_base=api_base,
+                           validate=parsable if task == 'judge' else None)["content"]
+        if message == API_ERROR_OUTPUT:
+            raise RuntimeError(API_ERROR_OUTPUT)
+        return message
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(explain, k): k for k in todo}
+        for future in as_completed(futures):
+            k = futures[future]
+            try:
+                message = future.result()
+                if task == 'judge':
+                    result = parse_judge(message)
+                elif task == 'similarity':
+                    result = {'ai_similarity': message, 'ai_similarity_source': 'judge'}
+                else:
+                    result = {'ai_explain': message}
+            except (RuntimeError, ValueError, KeyError, TypeError) as e:
+                # an unparsable judge response is failed too, to be retried on resume
+                manifest.mark(k, field, config, 'failed', error=e)
+                continue
+            print('*' * 20)
+            print(message)
+            print('*' * 20)
+            res[k].update(result)
+            store.append(k, result, index=indices[k])
+            manifest.mark(k, field, config, 'done')
+
+    store.close()
+    if res_path.suffix != '.jsonl':
+        compact_results(store_path, res_path)
+    print('API metrics: {}'.format(executor.metrics()))
+    if response_cache is not None:
+        print('Response cache: {}'.format(response_cache.stats()))
+
+
+def _decision(texts):
+    """
+    Parse the final decision from the first line of meta reviews, e.g. "Recommendation: Accept"
+    :param texts: pd.Series of meta reviews
+    :return: pd.Series of 'Accept' / 'Reject'
+    """
+    decision = texts.str.strip().str.split('\n', n=1).str[0].str.split(': ', n=1).str[1].str.strip()
+    lower = decision.str.lower()
+    decision = decision.mask(lower.str.contains('reject', na=False), 'Reject').mask(
+        lower.str.contains('accept', na=False), 'Accept')
+    assert decision.isin(['Accept', 'Reject']).all()
+    return decision
+
+
+def analysis_frame(res, raw):
+    """
+    Build the columnar analysis frame of a run in one pass
+    :param res: generated results, paper name -> paper info with ai_sum_meta
+    :param raw: crawled papers of raw.json
+    :return: pd.DataFrame indexed by paper name
+    """
+    import pandas as pd
+    df = pd.DataFrame.from_dict(res, orient='index', dtype=object)
+    info = pd.DataFrame.from_dict(raw, orient='index', dtype=object).loc[
+        df.index, ['pub_url', 'rating_avg', 'confidence_avg', 'soundness_avg', 'presentation_avg', 'contribution_avg']]
+
+    df['human_decision'] = _decision(df['meta_review'])
+    df['ai_decision'] = _decision(df['ai_sum_meta'])
+    df['rating_avg'] = info['rating_avg'].astype(float)
+    df['paper_info'] = (
+            "Title: " + df.index.to_series() + "\n"
+            + "Paper ID: " + df['paper_id'].map(str) + "\n"
+            + "Paper URL: " + info['pub_url'].map(str) + "\n"
+            + "PDF URL: " + df['pdf_link'].map(str) + "\n"
+            + "Avg_rating: " + info['rating_avg'].map(str) + "\n"
+            + "Avg_confidence: " + info['confidence_avg'].map(str) + "\n"
+            + "Avg_soundness: " + info['soundness_avg'].map(str) + "\n"
+            + "Avg_presentation: " + info['presentation_avg'].map(str) + "\n"
+            + "Avg_contribution: " + info['contribution_avg'].map(str) + "\n")
+
+    reviews = pd.DataFrame(df['reviews'].tolist(), index=df.index).reindex(columns=range(6))
+    for i in range(6):
+        df['R{}'.format(i + 1)] = reviews[i].fillna("")
+    return df
+
+
+def decision_metrics(df, bins=None):
+    """
+    Accuracy, per-class accuracy, confusion matrix and KL divergence of the score histograms of an analysis frame
+    :param df: frame of analysis_frame
+    :param bins: bins of the reviewer average score histograms, default from 0.0 to 11.0 with 0.3 intervals
+    :return: dict of metrics
+    """
+    import pandas as pd
+    from scipy import stats
+    if bins is None:
+        bins = np.arange(0, 11.3, 0.3)
+    human = df['human_decision'].to_numpy()
+    ai = df['ai_decision'].to_numpy()
+    scores = df['rating_avg'].to_numpy()
+
+    res = {
+        'acc': float(np.mean(human == ai)),
+        # acc_accept considers the case that both human and AI accept the paper
+        'acc_accept': float(np.sum((human == ai) & (human == 'Accept')) / np.sum(human == 'Accept')),
+        'acc_reject': float(np.sum((human == ai) & (human == 'Reject')) / np.sum(human == 'Reject')),
+        'confusion_matrix': pd.crosstab(df['human_decision'], df['ai_decision'],
+                                        rownames=['Human'], colnames=['AI']),
+    }
+    for decision in ['Accept', 'Reject']:
+        human_density = np.histogram(scores[human == decision], bins=bins)[0].astype(float)
+        ai_density = np.histogram(scores[ai == decision], bins=bins)[0].astype(float)
+        prob_human = human_density / human_density.sum()
+        prob_ai = ai_density / ai_density.sum()
+        # replace 0 with small value
+        prob_human[prob_human == 0] = 1e-10
+        prob_ai[prob_ai == 0] = 1e-10
+        res['kl_divergence_{}'.format(decision)] = float(stats.entropy(prob_human, prob_ai, base=2))
+    return res
+
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# keywords of the aspects a meta review may discuss, matched against lowercase tokens
+ASPECT_KEYWORDS = {
+    'Novelty': ('novel', 'novelty', 'original', 'originality', 'new'),
+    'Soundness': ('sound', 'soundness', 'correct', 'correctness', 'proof', 'proofs', 'rigorous', 'theoretical'),
+    'Presentation': ('presentation', 'clarity', 'clear', 'unclear', 'written', 'writing', 'organized'),
+    'Contribution': ('contribution', 'contributions', 'significance', 'significant', 'impact'),
+    'Experiments': ('experiment', 'experiments', 'empirical', 'evaluation', 'baseline', 'baselines', 'ablation'),
+    'Related Work': ('related', 'prior', 'literature'),
+    'Reproducibility': ('reproducibility', 'reproducible', 'reproduce', 'code'),
+    'Limitations': ('limitation', 'limitations', 'weakness', 'weaknesses'),
+    'Ethics': ('ethics', 'ethical', 'societal', 'broader'),
+}
+
+
+def _count_matrices(human, ai, ngram=1):
+    """
+    Sparse n-gram count matrices of the token lists of the human and AI reviews, over a shared vocabulary
+    :return: human counts, AI counts, vocabulary of n-gram -> column
+    """
+    from scipy import sparse
+    vocab = {}
+    matrices = []
+    for token_lists in (human, ai):
+        rows, cols = [], []
+        for i, tokens in enumerate(token_lists):
+            grams = list(zip(*(tokens[j:] for j in range(ngram))))
+            rows.extend([i] * len(grams))
+            cols.extend(vocab.setdefault(g, len(vocab)) for g in grams)
+        matrices.append((rows, cols))
+    # duplicated entries are summed into counts
+    return [sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(human), len(vocab)))
+            for rows, cols in matrices] + [vocab]
+
+
+def _ratio(a, b):
+    return np.divide(a, b, out=np.zeros(len(a)), where=b > 0)
+
+
+def _rouge(human, ai):
+    """
+    ROUGE F1 of every pair, from the n-gram count matrices
+    """
+    overlap = np.asarray(human.minimum(ai).sum(axis=1)).ravel()
+    recall = _ratio(overlap, np.asarray(human.sum(axis=1)).ravel())
+    precision = _ratio(overlap, np.asarray(ai.sum(axis=1)).ravel())
+    return _ratio(2 * precision * recall, precision + recall)
+
+
+def _bm25(human, ai, k1=1.2, b=0.75):
+    """
+    BM25 of the terms of every AI review against its human review, normalized by the human review against itself.
+    The idf is over the human reviews
+    """
+    from scipy import sparse
+    n = human.shape[0]
+    doc_freq = np.bincount(human.indices, minlength=human.shape[1])
+    idf = np.log1p((n - doc_freq + 0.5) / (doc_freq + 0.5))
+    lengths = np.asarray(human.sum(axis=1)).ravel()
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1))
+    weights = human.copy()
+    rows = np.repeat(np.arange(n), np.diff(human.indptr))
+    weights.data = human.data * (k1 + 1) / (human.data + norm[rows])
+    weights = weights @ sparse.diags(idf)
+    score = np.asarray(weights.multiply(ai > 0).sum(axis=1)).ravel()
+    return _ratio(score, np.asarray(weights.sum(axis=1)).ravel())
+
+
+def local_similarity(human, ai, ambiguity=0.6):
+    """
+    Score how close every AI meta review is to the human one without any request, as a fast pre-filter of the
+    similarity judge. All the pairs are scored at once on sparse term matrices: decision agreement, ROUGE-1/2 F1,
+    BM25 and the Jaccard overlap of the aspects mentioned, after ASPECT_KEYWORDS.
+    The score follows the rubric of the judge from 0 to 10: 6 for the same decision and 4 for the mean of the
+    content measures. A pair is ambiguous when its content measures disagree, i.e. their percentiles over the papers
+    span more than ambiguity, and is worth a request to the judge
+    :param human: pd.Series of human meta reviews, indexed by paper name
+    :param ai: pd.Series of AI meta reviews, same index
+    :param ambiguity: span of percentiles of an ambiguous pair
+    :return: pd.DataFrame indexed by paper name
+    """
+    import pandas as pd
+    from scipy import sparse
+    human_tokens = [TOKEN_PATTERN.findall(text.lower()) for text in human]
+    ai_tokens = [TOKEN_PATTERN.findall(text.lower()) for text in ai]
+
+    h1, a1, vocab = _count_matrices(human_tokens, ai_tokens, ngram=1)
+    h2, a2, _ = _count_matrices(human_tokens, ai_tokens, ngram=2)
+
+    # keyword -> aspect incidence, the aspects of a review are those with any keyword in it
+    cells = [(vocab[(w,)], k) for k, words in enumerate(ASPECT_KEYWORDS.values()) for w in words if (w,) in vocab]
+    incidence = sparse.csr_matrix((np.ones(len(cells)), ([r for r, _ in cells], [c for _, c in cells])),
+                                  shape=(len(vocab), len(ASPECT_KEYWORDS)))
+    human_aspects = (h1 @ incidence).toarray() > 0
+    ai_aspects = (a1 @ incidence).toarray() > 0
+
+    df = pd.DataFrame({
+        'decision_agree': (_decision(human) == _decision(ai)).to_numpy(),
+        'rouge1': _rouge(h1, a1),
+        'rouge2': _rouge(h2, a2),
+        'bm25': _bm25(h1, a1),
+        'aspect': _ratio((human_aspects & ai_aspects).sum(axis=1), (human_aspects | ai_aspects).sum(axis=1)),
+    }, index=human.index)
+    # neither mentioning any aspect is an agreement
+    df.loc[~(human_aspects | ai_aspects).any(axis=1), 'aspect'] = 1.0
+    content = df[['rouge1', 'rouge2', 'bm25', 'aspect']]
+    df['content'] = content.mean(axis=1)
+    df['score'] = 6 * df['decision_agree'] + 4 * df['content']
+    ranks = content.rank(pct=True)
+    df['ambiguous'] = (ranks.max(axis=1) - ranks.min(axis=1)) > ambiguity
+    return df
+
+
+def analysis(name, show=True):
     """
     Summarize the generated AI reviews with the real meta review and user study opinions
+    :param show: show the histograms, otherwise only save them
     :return:
     """
 
+    import pandas as pd
+    from scipy import stats
+
     print('Analysis of {}'.format(name))
 
-    src_path = Path('cache') / name
+    src_path = result_path(name)
     dst_path = Path('cache') / 'analysis_{}.xlsx'.format(src_path.stem)
 
     assert src_path.exists()
-    res = json.load(src_path.open())
+    res = load_results(src_path)
 
     raw = json.load(Path('cache/raw.json').open())
 
-    columns = ['Paper', 'Human meta review', 'Human meta decision',
-               'AI meta', 'AI meta decision', 'AI judge',
-               "R1", "R2", "R3", "R4", "R5", "R6"]
-    df = pd.DataFrame(columns=columns)
-
-    human_meta_decisions = []
-    ai_meta_decisions = []
-
-    human_avg_scores = []
-
-    max_nb = 0
-    for paper in res.items():
-        ai_meta_decision = paper[1]['ai_sum_meta'].strip().split('\n')[0].split(': ')[1].strip()
-        ai_meta_decision = 'Accept' if 'accept' in ai_meta_decision.lower() else ai_meta_decision
-        ai_meta_decision = 'Reject' if 'reject' in ai_meta_decision.lower() else ai_meta_decision
-        assert ai_meta_decision in ['Accept', 'Reject']
-        human_meta_decision = paper[1]['meta_review'].strip().split('\n')[0].split(': ')[1].strip()
-        human_meta_decision = 'Accept' if 'accept' in human_meta_decision.lower() else human_meta_decision
-        human_meta_decision = 'Reject' if 'reject' in human_meta_decision.lower() else human_meta_decision
-        assert human_meta_decision in ['Accept', 'Reject']
-
-        paper_info = \
-            (f"Title: {paper[0]}\n"
-             f"Paper ID: {paper[1]['paper_id']}\n"
-             f"Paper URL: {raw[paper[0]]['pub_url']}\n"
-             f"PDF URL: {paper[1]['pdf_link']}\n"
-             f"Avg_rating: {raw[paper[0]]['rating_avg']}\n"
-             f"Avg_confidence: {raw[paper[0]]['confidence_avg']}\n"
-             f"Avg_soundness: {raw[paper[0]]['soundness_avg']}\n"
-             f"Avg_presentation: {raw[paper[0]]['presentation_avg']}\n"
-             f"Avg_contribution: {raw[paper[0]]['contribution_avg']}\n")
-
-        if len(paper[1]['reviews']) > max_nb:
-            max_nb = len(paper[1]['reviews'])
-        df_new = pd.DataFrame(
-            {
-                'Paper': paper_info,
-                'Human meta review': paper[1]['meta_review'],
-                'Human meta decision': human_meta_decision,
-                'AI meta': paper[1]['ai_sum_meta'],
-                'AI meta decision': ai_meta_decision,
-                # 'AI judge': paper[1]['judge_ai_sum_meta'],
-                "R1": paper[1]['reviews'][0] if len(paper[1]['reviews']) > 0 else "",
-                "R2": paper[1]['reviews'][1] if len(paper[1]['reviews']) > 1 else "",
-                "R3": paper[1]['reviews'][2] if len(paper[1]['reviews']) > 2 else "",
-                "R4": paper[1]['reviews'][3] if len(paper[1]['reviews']) > 3 else "",
-                "R5": paper[1]['reviews'][4] if len(paper[1]['reviews']) > 4 else "",
-                "R6": paper[1]['reviews'][5] if len(paper[1]['reviews']) > 5 else "",
-            },
-            index=[paper[0]])
-        df = pd.concat([df, df_new])
-        human_meta_decisions.append(human_meta_decision)
-        human_avg_scores.append(raw[paper[0]]['rating_avg'])
-        ai_meta_decisions.append(ai_meta_decision)
-
-    df.to_excel(dst_path, index=False)
-
-    # compute the accuracy
-    acc = sum([1 if x == y else 0 for x, y in zip(human_meta_decisions, ai_meta_decisions)]) / len(human_meta_decisions)
-    # acc_accept considers the case that both human and AI accept the paper
-    accept_nb = sum([1 if x == 'Accept' else 0 for x in human_meta_decisions])
-    reject_nb = sum([1 if x == 'Reject' else 0 for x in human_meta_decisions])
-    acc_accept = sum(
-        [1 if x == y == 'Accept' else 0 for x, y in zip(human_meta_decisions, ai_meta_decisions)]) / accept_nb
-    acc_reject = sum(
-        [1 if x == y == 'Reject' else 0 for x, y in zip(human_meta_decisions, ai_meta_decisions)]) / reject_nb
+    df = analysis_frame(res, raw)
+    similarity = local_similarity(df['meta_review'], df['ai_sum_meta'])
+    pd.DataFrame({
+        'Paper': df['paper_info'],
+        'Human meta review': df['meta_review'],
+        'Human meta decision': df['human_decision'],
+        'AI meta': df['ai_sum_meta'],
+        'AI meta decision': df['ai_decision'],
+        'AI judge': None,
+        'Local similarity': similarity['score'],
+        **{'R{}'.format(i + 1): df['R{}'.format(i + 1)] for i in range(6)},
+    }).to_excel(dst_path, index=False)
+
+    metrics = decision_metrics(df)
+    acc, acc_accept, acc_reject = metrics['acc'], metrics['acc_accept'], metrics['acc_reject']
     print('Accuracy: {}'.format(acc))
     print('Accuracy of Accept: {}'.format(acc_accept))
     print('Accuracy of Reject: {}'.format(acc_reject))
+    print('Confusion matrix:\n{}'.format(metrics['confusion_matrix']))
+    print('Local similarity: mean {:.2f}, ROUGE-1 {:.3f}, BM25 {:.3f}, aspects {:.3f}, ambiguous pairs {}'.format(
+        similarity['score'].mean(), similarity['rouge1'].mean(), similarity['bm25'].mean(), similarity['aspect'].mean(),
+        int(similarity['ambiguous'].sum())))
 
     # make a histogram, ranging score from 0 to 10, check whether the AI judge is similar to the human judge
-    human_score2decision = zip(human_avg_scores, human_meta_decisions)
-    human_score2decision = sorted(human_score2decision, key=lambda x: x[0])
-    human_score2decision = list(human_score2decision)
-    ai_score2decision = zip(human_avg_scores, ai_meta_decisions)
-    ai_score2decision = sorted(ai_score2decision, key=lambda x: x[0])
-    ai_score2decision = list(ai_score2decision)
+    human_avg_scores = df['rating_avg'].to_numpy()
+    human_meta_decisions = df['human_decision'].to_numpy()
+    ai_meta_decisions = df['ai_decision'].to_numpy()
     import matplotlib.pyplot as plt
 
     decisions = ['Accept', 'Reject']
@@ -446,8 +2137,8 @@ def analysis(name):
     res = {}
 
     for decision, color in zip(decisions, colors):
-        human_scores = np.array([x[0] for x in human_score2decision if x[1] == decision])
-        ai_scores = np.array([x[0] for x in ai_score2decision if x[1] == decision])
+        human_scores = human_avg_scores[human_meta_decisions == decision]
+        ai_scores = human_avg_scores[ai_meta_decisions == decision]
 
         # Calculate mean and confidence interval for each group
         ai_mean = np.mean(ai_scores)
@@ -477,24 +2168,15 @@ def analysis(name):
         plt.xlabel('Reviewer Average Score')
         plt.ylabel('Paper Number')
 
-        # KL divergence
-        from scipy.stats import entropy
-        prob_human = human_density[0] / human_density[0].sum()
-        prob_ai = ai_density[0] / ai_density[0].sum()
-        # replace 0 with small value
-        prob_human[prob_human == 0] = 1e-10
-        prob_ai[prob_ai == 0] = 1e-10
-        # # remove the zero values
-        # prob_human = prob_human[prob_human != 0]
-        # prob_ai = prob_ai[prob_ai != 0]
-        # # padding
-        # max_length
-        kl_divergence = entropy(prob_human, prob_ai, base=2)
+        kl_divergence = metrics['kl_divergence_{}'.format(decision)]
         print(f'KL divergence of {decision}ed papers: {kl_divergence:.2f}')
 
         # Save and display the histogram
         plt.savefig(dst_path.parent / f'histogram_{decision}_{src_path.stem}.png', dpi=300, bbox_inches='tight')
-        plt.show()
+        if show:
+            plt.show()
+        else:
+            plt.close()
 
         res[decision] = {
             'acc': acc,
@@ -506,81 +2188,494 @@ def analysis(name):
     return res
 
 
-def explain_analysis(name, model_name='gpt-3.5-turbo-16k'):
-    res = json.load(Path('cache').joinpath(name).open())
-    similar = ""
-    diff = ""
+def _load_field(path, field='ai_sum_meta'):
+    """
+    Load a single generated field of a result file, run in worker processes by compare_runs
+    :return: dict of paper name -> field
+    """
+    return {k: v[field] for k, v in load_records(path).items() if field in v}
+
+
+def compare_runs(names=None, workers=4, show=True):
+    """
+    Compare the decisions of many runs against the same human meta reviews.
+    raw.json is loaded and the human decisions are parsed once, the result files are loaded in parallel processes.
+    :param names: result file names, default to every gen_*.json(l) under cache/
+    :param workers: number of processes loading result files
+    :param show: show the figure, otherwise only save it
+    :return: pd.DataFrame with one row per run
+    """
+    import pandas as pd
+    if names is None:
+        names = sorted({p.stem + '.json' for p in Path('cache').glob('gen_*.json*') if '.manifest' not in p.name})
+    paths = [result_path(name) for name in names]
+    raw = json.load(Path('cache/raw.json').open())
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        metas = list(pool.map(_load_field, paths))
+
+    papers = [k for k in raw if any(k in meta for meta in metas)]
+    base = pd.DataFrame({
+        'meta_review': [raw[k]['meta_review'] for k in papers],
+        'rating_avg': [raw[k]['rating_avg'] for k in papers],
+    }, index=papers)
+    base['rating_avg'] = base['rating_avg'].astype(float)
+    base['human_decision'] = _decision(base['meta_review'])
+
+    rows = []
+    for path, meta in zip(paths, metas):
+        df = base.loc[[k for k in papers if k in meta]].copy()
+        df['ai_decision'] = _decision(pd.Series(meta)).loc[df.index]
+        metrics = decision_metrics(df)
+        rows.append({
+            'run': path.stem,
+            'papers': len(df),
+            'acc': metrics['acc'],
+            'acc_accept': metrics['acc_accept'],
+            'acc_reject': metrics['acc_reject'],
+            'kl_accept': metrics['kl_divergence_Accept'],
+            'kl_reject': metrics['kl_divergence_Reject'],
+        })
+    table = pd.DataFrame(rows)
+    print(table.to_string(index=False))
+    table.to_excel(Path('cache') / 'comparison.xlsx', index=False)
+
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(1, 2, figsize=(14, 0.4 * len(table) + 2), sharey=True)
+    table.plot.barh(x='run', y=['acc', 'acc_accept', 'acc_reject'], ax=axes[0], title='Accuracy')
+    table.plot.barh(x='run', y=['kl_accept', 'kl_reject'], ax=axes[1], title='KL divergence')
+    axes[0].set_ylabel('')
+    plt.savefig(Path('cache') / 'comparison.png', dpi=300, bbox_inches='tight')
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
+    return table
+
+
+ASPECT_PATTERN = re.compile(r'^\s*(?:[-*]\s*|\d+[.)]\s*)?\(([^()\n]{2,60})\)\s*:', re.MULTILINE)
+
+
+def aspect_counts(texts):
+    """
+    Count the aspects of the ai_explain analyses, e.g. "(Novelty): ...", each aspect counted once per paper
+    :param texts: similarities or differences part of the analysis of each paper
+    :return: list of (aspect, number of papers), most frequent first, ties by name
+    """
+    counts = Counter()
+    for text in texts:
+        counts.update(set(' '.join(a.split()).title() for a in ASPECT_PATTERN.findall(text)))
+    return sorted(counts.items(), key=lambda x: (-x[1], x[0]))
+
+
+def _token_shards(blocks, max_tokens, model_name):
+    """
+    Split consecutive text blocks into shards of at most max_tokens, a block over the budget being a shard alone
+    :return: list of lists of blocks
+    """
+    shards, shard, size = [], [], 0
+    for block in blocks:
+        n = num_tokens(block, model_name)
+        if shard and size + n > max_tokens:
+            shards.append(shard)
+            shard, size = [], 0
+        shard.append(block)
+        size += n
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def explain_analysis(name, model_name='gpt-3.5-turbo-16k', max_tokens=12000, workers=4, max_depth=4, executor=None,
+                     api_base=None):
+    """
+    Summarize the similarities and differences found by ai_explainer over all the papers.
+    The analyses are summarized hierarchically: while they do not fit in max_tokens, they are split into
+    token-bounded shards summarized concurrently, and the summaries replace them. The number of papers mentioning
+    each aspect is counted from the analyses and given to the final summary instead of being estimated by the model
+    :param name: result file with ai_explain
+    :param model_name: OpenAI model name
+    :param max_tokens: token budget of the text of a single request
+    :param workers: number of shards summarized concurrently
+    :param max_depth: maximum number of summary levels before the final summary
+    :param executor: RequestExecutor, default to the module one
+    :param api_base: OpenAI-compatible API base url
+    :return: dict of mode ('similar' / 'diff') -> {'summary', 'aspects', 'depth'}
+    """
+    from langchain import PromptTemplate
+    from langchain.chat_models import ChatOpenAI
+    from langchain.chains.llm import LLMChain
+    from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+    from langchain.docstore.document import Document
+
+    res = load_results(result_path(name))
+    similar = []
+    diff = []
+    # papers left to their local similarity by a prefiltered judge have no explanation
+    res = {k: v for k, v in res.items() if 'ai_explain' in v}
     for idx, (k, v) in enumerate(res.items()):
         ax = v['ai_explain']
         similar_text = ax.split('Differences:')[0].strip().split('Similarities:')[1].strip()
         diff_text = ax.split('Differences:')[1].strip()
-        similar += "The similarities analysis of paper {} is: \n".format(idx) + '\n' + similar_text + '\n\n'
-        diff += "The differences analysis of paper {} is: \n".format(idx) + '\n' + diff_text + '\n\n'
+        similar.append((similar_text, "The similarities analysis of paper {} is: \n".format(idx) + '\n' + similar_text
+                        + '\n\n'))
+        diff.append((diff_text, "The differences analysis of paper {} is: \n".format(idx) + '\n' + diff_text + '\n\n'))
 
     prompt_similar = ("Summarize an analysis of human/AI meta reviews': {text}. "
-                      "Find out the common aspects that human and AI reviewers agree on. "
-                      "If possible, give the estimated frequency/numbers of each aspect. ")
+                      "Find out the common aspects that human and AI reviewers agree on. ")
 
     prompt_diff = ("Summarize an analysis of differences of human/AI meta reviews. {text}"
                    "Find out the common aspects that human and AI reviewers disagree on, "
-                   "or the common aspects of the differences. "
-                   "Give the estimated frequency and numbers of each aspect."
-                   "Give examples for each.")
+                   "or the common aspects of the differences. ")
+
+    # the final summary gets the counted frequencies, a shard summary keeps examples for the levels above
+    prompt_counts = ("Give the frequency of each aspect with these numbers of papers mentioning it, "
+                     "out of {} papers: {}. ")
+    prompt_examples = {'similar': "Give a short example for each.", 'diff': "Give examples for each."}
+
+    executor = executor or api_executor
+    # retries are left to the executor
+    llm = _executor_llm(ChatOpenAI(temperature=0, model_name=model_name, openai_api_base=api_base, max_retries=1),
+                        executor, api_base)
+
+    def summarize(prompt, blocks):
+        stuff_chain = StuffDocumentsChain(llm_chain=LLMChain(llm=llm, prompt=PromptTemplate.from_template(prompt)),
+                                          document_variable_name="text")
+        text = ''.join(blocks)
+        docs = [Document(page_content=text, metadata={})]
+        return stuff_chain.run(docs)
 
-    summaries = []
-    for mode, text in zip(["similar", "diff"], [similar, diff]):
-        llm = ChatOpenAI(temperature=0, model_name=model_name)
+    def reduce(mode, analyses, pool):
         prompt = prompt_similar if mode == 'similar' else prompt_diff
-        llm_chain = LLMChain(llm=llm, prompt=PromptTemplate.from_template(prompt))
-        stuff_chain = StuffDocumentsChain(llm_chain=llm_chain, document_variable_name="text")
-        docs = [Document(page_content=similar if mode == 'similar' else diff, metadata={})]
-        summary = stuff_chain.run(docs)
-        summaries.append(summary)
-        print(summary)
+        aspects = aspect_counts([text for text, _ in analyses])
+        blocks = [block for _, block in analyses]
+        depth = 0
+        while len(blocks) > 1 and sum(num_tokens(b, model_name) for b in blocks) > max_tokens and depth < max_depth:
+            shards = _token_shards(blocks, max_tokens, model_name)
+            summaries = pool.map(lambda shard: summarize(prompt + prompt_examples[mode], shard), shards)
+            blocks = ["The summary of analyses group {} is: \n\n{}\n\n".format(i, s) for i, s in enumerate(summaries)]
+            depth += 1
+        counts = ', '.join('{}: {}'.format(a, n) for a, n in aspects).replace('{', '{{').replace('}', '}}')
+        final_prompt = prompt + prompt_counts.format(len(analyses), counts) + prompt_examples[mode]
+        return {'summary': summarize(final_prompt, blocks), 'aspects': aspects, 'depth': depth}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=2) as modes:
+        futures = {mode: modes.submit(reduce, mode, analyses, pool) for mode, analyses in
+                   zip(["similar", "diff"], [similar, diff])}
+        summaries = {mode: future.result() for mode, future in futures.items()}
+    for mode, summary in summaries.items():
+        print('{} aspects: {}'.format(mode, summary['aspects'][:10]))
+        print(summary['summary'])
+    return summaries
+
+
+# the 12 cells of the study in the README, keyword arguments of generate_meta_from_reviews
+STUDY_GRID = [
+    {},
+    {'confidence': 'Certain'},
+    {'strictness': 0.9},
+    {'strictness': 0.9, 'confidence': 'Certain'},
+    {'strictness': 0.5},
+    {'strictness': 0.5, 'confidence': 'Certain'},
+    {'strictness': 0.3},
+    {'strictness': 0.3, 'confidence': 'Certain'},
+    {'strictness': 1.0},
+    {'strictness': 1.0, 'confidence': 'Certain'},
+    {'score': False},
+    {'strictness': 0.9, 'score': False},
+]
+
+
+def sweep_grid(models=('gpt-3.5-turbo-16k',), strictness=(None,), confidence=(None,), score=(True,)):
+    """
+    Cartesian grid of generation settings
+    :return: list of cells for run_sweep
+    """
+    return [{'model_name': m, 'strictness': st, 'confidence': c, 'score': sc}
+            for m in models for st in strictness for c in confidence for sc in score]
+
+
+def run_sweep(grid=None, model_name='gpt-3.5-turbo-16k', explain=False, parallel=4, workers=4, rpm=None, tpm=None,
+              api_base=None, digest=False):
+    """
+    Run the generate -> analysis / explain DAG of every cell of a grid.
+    Cells run in parallel under one API budget, stages whose outputs are up to date are skipped.
+    :param grid: list of cells (model_name, strictness, confidence, score), default to STUDY_GRID
+    :param model_name: model of the cells not giving one
+    :param explain: also run ai_explainer on every cell
+    :param parallel: number of cells running at the same time
+    :param workers: number of papers generated concurrently in a cell
+    :param rpm: global requests-per-minute budget
+    :param tpm: global tokens-per-minute budget
+    :param api_base: OpenAI-compatible API base url
+    :param digest: build the prompts of the cells not giving it from review digests, see generate_meta_from_reviews
+    :return: dict of run name -> status or result of each stage
+    """
+    cells = [{'model_name': model_name, 'strictness': None, 'confidence': None, 'score': True, 'digest': digest,
+              **cell} for cell in (grid or STUDY_GRID)]
+    executor = RequestExecutor(limiter=RateLimiter(rpm=rpm, tpm=tpm))
+    res = _load_papers()
+    papers = set(res)
+    # the reviews are digested once up front, the cells then only pay for their meta reviews
+    for digest_model in sorted(set(cell['model_name'] for cell in cells if cell['digest'])):
+        digest_reviews(res, digest_model, workers=workers * parallel, executor=executor, api_base=api_base)
+
+    def up_to_date(dst_path, field, config):
+        manifest = Manifest(dst_path.with_suffix('.jsonl'))
+        if field in manifest.progress():
+            return papers <= manifest.completed(field, config)
+        # results from before the manifest existed are trusted when complete
+        src_path = result_path(dst_path.name)
+        if not src_path.exists():
+            return False
+        res = load_results(src_path)
+        return all(k in res and field in res[k] for k in papers)
+
+    def generate(cell):
+        prompt_template, dst_path = _meta_prompt(**cell)
+        if up_to_date(dst_path, 'ai_sum_meta', _meta_config(cell['model_name'], prompt_template, cell['score'],
+                                                            digest=cell['digest'])):
+            return 'skipped'
+        generate_meta_from_reviews(**cell, workers=workers, api_base=api_base, resume=True, executor=executor)
+        return 'done'
+
+    def explain_run(dst_path):
+        sys_prompt, question, prompt_template = _explain_prompt()
+        if up_to_date(dst_path, 'ai_explain', config_hash('explanation', sys_prompt, question, prompt_template)):
+            return 'skipped'
+        ai_explainer(dst_path.name, resume=True, executor=executor, api_base=api_base)
+        return 'done'
+
+    def analyze(dst_path):
+        src_path = result_path(dst_path.name)
+        xlsx_path = Path('cache') / 'analysis_{}.xlsx'.format(src_path.stem)
+        # only new meta reviews make an analysis stale, not explanations appended to the same store
+        updated = Manifest(dst_path.with_suffix('.jsonl')).last_done('ai_sum_meta') or src_path.stat().st_mtime
+        if xlsx_path.exists() and xlsx_path.stat().st_mtime >= updated:
+            return 'skipped'
+        return analysis(dst_path.name, show=False)
+
+    report = {}
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        generate_futures = {pool.submit(generate, cell): _meta_prompt(**cell)[1] for cell in cells}
+        explain_futures = {}
+        for future in as_completed(generate_futures):
+            dst_path = generate_futures[future]
+            report[dst_path.stem] = {}
+            try:
+                report[dst_path.stem]['generate'] = future.result()
+            except Exception as e:
+                print(f"Failed to generate {dst_path.stem}: {e}")
+                report[dst_path.stem]['generate'] = 'failed'
+                continue
+            if explain:
+                explain_futures[pool.submit(explain_run, dst_path)] = dst_path
+            # matplotlib is not thread-safe, so analyses run one by one in this thread
+            try:
+                report[dst_path.stem]['analysis'] = analyze(dst_path)
+            except Exception as e:
+                print(f"Failed to analyze {dst_path.stem}: {e}")
+                report[dst_path.stem]['analysis'] = 'failed'
+
+        for future in as_completed(explain_futures):
+            dst_path = explain_futures[future]
+            try:
+                report[dst_path.stem]['explain'] = future.result()
+            except Exception as e:
+                print(f"Failed to explain {dst_path.stem}: {e}")
+                report[dst_path.stem]['explain'] = 'failed'
+
+    for run, stages in report.items():
+        print(run, {k: v if isinstance(v, str) else 'done' for k, v in stages.items()})
+    print('API metrics: {}'.format(executor.metrics()))
+    return report
+
+
+# modules imported by each command of the CLI, loaded up front so that --timing reports them
+COMMAND_DEPS = {
+    'generate': ['openai', 'langchain', 'langchain.chat_models', 'langchain.chains.llm',
+                 'langchain.chains.combine_documents.stuff'],
+    'analyze': ['pandas', 'scipy.stats', 'matplotlib.pyplot'],
+    'sweep': ['openai', 'langchain', 'langchain.chat_models', 'langchain.chains.llm',
+              'langchain.chains.combine_documents.stuff', 'pandas', 'scipy.stats', 'matplotlib.pyplot'],
+    'batch': ['requests'],
+    'progress': [],
+    'dedup': [],
+    'compact': [],
+    'explain': ['openai'],
+    'pdf-text': ['langchain.document_loaders.pdf'],
+    'pdf-review': ['langchain', 'langchain.llms', 'langchain.chains', 'langchain.chains.question_answering',
+                   'langchain.document_loaders.pdf', 'langchain.text_splitter', 'langchain.embeddings',
+                   'langchain.vectorstores'],
+}
+
+
+def startup_times(commands=None, repeat=3):
+    """
+    Startup time of CLI commands, each measured in a fresh interpreter: import of main and of the command dependencies
+    :param commands: commands of COMMAND_DEPS, default to all
+    :param repeat: runs per command, the fastest is kept
+    :return: dict of command -> seconds
+    """
+    import subprocess
+    import sys
+
+    code = ("import time; t = time.perf_counter(); import importlib, main; "
+            "[importlib.import_module(m) for m in main.COMMAND_DEPS[{!r}]]; print(time.perf_counter() - t)")
+    res = {}
+    for command in commands or COMMAND_DEPS:
+        runs = [float(subprocess.run([sys.executable, '-c', code.format(command)], check=True, capture_output=True,
+                                     text=True, cwd=Path(__file__).parent).stdout) for _ in range(repeat)]
+        res[command] = min(runs)
+        print('{}: {:.3f}s'.format(command, res[command]))
+    return res
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='Generate and analyze AI meta reviews of NeurIPS papers')
+    parser.add_argument('--timing', action='store_true', help='report the startup time of the command')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the persistent response cache')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help='generate meta reviews from the human reviews')
+    generate.add_argument('--model', default='gpt-3.5-turbo-16k')
+    generate.add_argument('--strictness', type=float, default=None)
+    generate.add_argument('--confidence', choices=['Certain', 'Less Certain'], default=None)
+    generate.add_argument('--no-score', action='store_true', help='leave the reviewer scores out of the prompt')
+    generate.add_argument('--workers', type=int, default=1)
+    generate.add_argument('--rpm', type=int, default=None)
+    generate.add_argument('--tpm', type=int, default=None)
+    generate.add_argument('--api-base', default=None)
+    generate.add_argument('--resume', action='store_true')
+    generate.add_argument('--compact', action='store_true')
+    generate.add_argument('--digest', action='store_true',
+                          help='build the prompts from review digests, cached across settings')
+    generate.add_argument('--budget', type=int, default=None,
+                          help='compact the reviews of each prompt to this many tokens with the default policy')
+
+    sweep = commands.add_parser('sweep', help='generate and analyze every setting of a grid, the study by default')
+    sweep.add_argument('--grid', default=None,
+                       help='JSON list of settings, e.g. \'[{"strictness": 0.9}]\', default to STUDY_GRID')
+    sweep.add_argument('--model', default='gpt-3.5-turbo-16k')
+    sweep.add_argument('--explain', action='store_true', help='also run ai_explainer on every setting')
+    sweep.add_argument('--digest', action='store_true', help='build the prompts from review digests')
+    sweep.add_argument('--parallel', type=int, default=4, help='settings run concurrently')
+    sweep.add_argument('--workers', type=int, default=4, help='papers of a setting run concurrently')
+    sweep.add_argument('--rpm', type=int, default=None)
+    sweep.add_argument('--tpm', type=int, default=None)
+    sweep.add_argument('--api-base', default=None)
+
+    batch = commands.add_parser('batch', help='generate meta reviews through the batch API')
+    batch.add_argument('--model', default='gpt-3.5-turbo-16k')
+    batch.add_argument('--strictness', type=float, default=None)
+    batch.add_argument('--confidence', choices=['Certain', 'Less Certain'], default=None)
+    batch.add_argument('--no-score', action='store_true', help='leave the reviewer scores out of the prompt')
+    batch.add_argument('--poll-interval', type=float, default=60)
+    batch.add_argument('--compact', action='store_true')
+
+    progress_parser = commands.add_parser('progress', help='report the progress of runs from their manifests')
+    progress_parser.add_argument('names', nargs='+', help='result files under cache/')
+
+    dedup = commands.add_parser('dedup', help='convert legacy result .json files into .jsonl stores')
+    dedup.add_argument('names', nargs='+')
+    dedup.add_argument('--remove', action='store_true', help='remove the legacy .json')
+
+    compact = commands.add_parser('compact', help='write the legacy .json of .jsonl stores')
+    compact.add_argument('names', nargs='+')
+
+    analyze = commands.add_parser('analyze', help='compare generated meta reviews with the human ones')
+    analyze.add_argument('names', nargs='*', help='result files under cache/, e.g. gen_gpt-3.5-turbo-16k.json')
+    analyze.add_argument('--compare', action='store_true', help='compare the runs, default to every run in cache/')
+    analyze.add_argument('--no-show', action='store_true', help='only save the figures')
+
+    explain = commands.add_parser('explain', help='judge generated meta reviews against the human ones')
+    explain.add_argument('name')
+    explain.add_argument('--task', choices=['similarity', 'explanation', 'judge'], default='explanation')
+    explain.add_argument('--workers', type=int, default=4, help='papers explained concurrently')
+    explain.add_argument('--prefilter', action='store_true',
+                         help='only judge the pairs the local similarity scorer finds ambiguous')
+    explain.add_argument('--resume', action='store_true')
+    explain.add_argument('--api-base', default=None)
+    explain.add_argument('--summarize', action='store_true', help='also summarize the explanations')
+    explain.add_argument('--model', default='gpt-3.5-turbo-16k', help='model of the summary')
+
+    pdf_text = commands.add_parser('pdf-text', help='extract the text of the paper PDFs into the text cache')
+    pdf_text.add_argument('--workers', type=int, default=None)
+
+    pdf_review = commands.add_parser('pdf-review', help='generate meta reviews from the paper PDFs')
+    pdf_review.add_argument('--model', default='gpt-4')
+    pdf_review.add_argument('--workers', type=int, default=4)
+    pdf_review.add_argument('--resume', action='store_true')
+    pdf_review.add_argument('--api-base', default=None)
+
+    startup = commands.add_parser('startup', help='measure the startup time of each command')
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.add_argument('--budget', type=float, default=None, help='fail if a command takes longer, in seconds')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'startup':
+        times = startup_times(repeat=args.repeat)
+        if args.budget is not None and max(times.values()) > args.budget:
+            raise SystemExit('Startup time over the budget of {}s'.format(args.budget))
+        return
+
+    ready = time.perf_counter()
+    deps = COMMAND_DEPS[args.command]
+    if args.command == 'explain' and args.summarize:
+        deps = deps + COMMAND_DEPS['generate']
+    for module in deps:
+        importlib.import_module(module)
+    if args.timing:
+        print('Startup: import main {:.3f}s, {} dependencies {:.3f}s'.format(
+            ready - _import_start, args.command, time.perf_counter() - ready))
+
+    if not args.no_cache and args.command in ['generate', 'sweep', 'explain', 'pdf-review']:
+        enable_response_cache(langchain_cache='langchain' in deps)
+
+    if args.command == 'generate':
+        generate_meta_from_reviews(model_name=args.model, strictness=args.strictness, confidence=args.confidence,
+                                   score=not args.no_score, workers=args.workers, rpm=args.rpm, tpm=args.tpm,
+                                   api_base=args.api_base, compact=args.compact, resume=args.resume,
+                                   policy=CompactionPolicy(budget=args.budget) if args.budget else None,
+                                   digest=args.digest)
+    elif args.command == 'sweep':
+        run_sweep(grid=json.loads(args.grid) if args.grid else None, model_name=args.model, explain=args.explain,
+                  parallel=args.parallel, workers=args.workers, rpm=args.rpm, tpm=args.tpm, api_base=args.api_base,
+                  digest=args.digest)
+    elif args.command == 'batch':
+        generate_meta_batch(model_name=args.model, strictness=args.strictness, confidence=args.confidence,
+                            score=not args.no_score, poll_interval=args.poll_interval, compact=args.compact)
+    elif args.command == 'progress':
+        for name in args.names:
+            progress(name)
+    elif args.command == 'dedup':
+        for name in args.names:
+            dedup_results(name, remove=args.remove)
+    elif args.command == 'compact':
+        for name in args.names:
+            compact_results((Path('cache') / name).with_suffix('.jsonl'))
+    elif args.command == 'analyze':
+        for name in args.names:
+            analysis(name, show=not args.no_show)
+        if args.compare:
+            compare_runs(names=args.names or None, show=not args.no_show)
+    elif args.command == 'explain':
+        ai_explainer(args.name, task=args.task, resume=args.resume, api_base=args.api_base,
+                     workers=args.workers, prefilter=args.prefilter)
+        if args.summarize:
+            explain_analysis(args.name, model_name=args.model, api_base=args.api_base)
+    elif args.command == 'pdf-text':
+        extract_pdf_texts(workers=args.workers)
+    elif args.command == 'pdf-review':
+        generate_meta_from_pdf(model_name=args.model, workers=args.workers, resume=args.resume, api_base=args.api_base)
 
 
 if __name__ == '__main__':
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k')
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', confidence='Certain')
-    #
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=0.9)
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=0.9, confidence='Certain')
-    #
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=0.5)
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=0.5, confidence='Certain')
-    #
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=0.3)
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=0.3, confidence='Certain')
-    #
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=1.0)
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=1.0, confidence='Certain')
-    #
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', score=False)
-    # generate_meta_from_reviews(model_name='gpt-3.5-turbo-16k', strictness=0.9, score=False)
-    #
-    # analysis(name='gen_gpt-3.5-turbo-16k.json')
-    analysis(name='gen_gpt-3.5-turbo-16k_certain.json')
-    #
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_0.9.json')
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_0.9_certain.json')
-    #
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_0.5.json')
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_0.5_certain.json')
-    #
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_0.3.json')
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_0.3_certain.json')
-    #
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_1.0.json')
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_1.0_certain.json')
-    #
-    # analysis(name='gen_gpt-3.5-turbo-16k_NoScore.json')
-    # analysis(name='gen_gpt-3.5-turbo-16k_strictness_0.9_NoScore.json')
-
-    # ai_explainer('gen_gpt-3.5-turbo-16k.json')
-    # ai_explainer('gen_gpt-3.5-turbo-16k_strictness_0.9.json')
-    # ai_explainer('gen_gpt-3.5-turbo-16k_strictness_0.5.json')
-    # ai_explainer('gen_gpt-3.5-turbo-16k_strictness_0.3.json')
-
-    # explain_analysis("gen_gpt-3.5-turbo-16k.json")
-
-    print()
+    # e.g. python main.py generate --strictness 0.9 --confidence Certain
+    #      python main.py analyze gen_gpt-3.5-turbo-16k.json gen_gpt-3.5-turbo-16k_strictness_0.9.json --compare
+    #      python main.py explain gen_gpt-3.5-turbo-16k.json --summarize
+    #      python main.py sweep --explain
+    #      python main.py progress gen_gpt-3.5-turbo-16k.json
+    #      python main.py startup --budget 2
+    cli()
@@ -0,0 +1,37 @@
+import threading
+
+import openai
+
+import main
+
+
+def _open_breaker(executor):
+    def fail():
+        raise openai.error.RateLimitError('rate limited')
+
+    try:
+        executor.call(fail)
+    except openai.error.RateLimitError:
+        pass
+    assert executor.state == 'open'
+
+
+def test_breaker_probe_non_retryable_error():
+    executor = main.RequestExecutor(max_retries=0, breaker_threshold=1, breaker_cooldown=0.1)
+    _open_breaker(executor)
+
+    def invalid():
+        raise openai.error.InvalidRequestError('bad request', param=None)
+
+    try:
+        executor.call(invalid)
+    except openai.error.InvalidRequestError:
+        pass
+    assert executor.state != 'half_open'
+
+    res = []
+    thread = threading.Thread(target=lambda: res.append(executor.call(lambda: 'ok')), daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    assert res == ['ok']
+    assert executor.state == 'closed'